@@ -1,12 +1,36 @@
-from functools import lru_cache, wraps
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import cProfile
+import fcntl
+from functools import wraps
+import hashlib
+import json
 import logging
 import os
 import random
 import re
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import urllib
-
-from flask import Blueprint, Flask, current_app, jsonify, request
+import xml.etree.ElementTree as ET
+
+import click
+from flask import (
+    Blueprint,
+    Flask,
+    current_app,
+    g,
+    has_app_context,
+    jsonify,
+    make_response,
+    request,
+)
+from flask.cli import with_appcontext
+from gunicorn.app.base import BaseApplication
 import requests
 
 
@@ -15,6 +39,46 @@ appservice_bp = Blueprint("appservice_endpoints", __name__)
 
 CONFIG_ERROR_EXITCODE = 2
 
+# Sync filters for the reconciler. The first sync only fetches a token,
+# later syncs only fetch changes to bans and power levels.
+EMPTY_SYNC_FILTER = {
+    "presence": {"types": []},
+    "account_data": {"types": []},
+    "room": {"rooms": []},
+}
+RECONCILE_SYNC_FILTER = {
+    "presence": {"types": []},
+    "account_data": {"types": []},
+    "room": {
+        "state": {"types": ["m.room.member", "m.room.power_levels"]},
+        "timeline": {"types": ["m.room.member", "m.room.power_levels"]},
+        "ephemeral": {"types": []},
+        "account_data": {"types": []},
+    },
+}
+
+# https://matrix.org/docs/spec/appendices#user-identifiers
+USER_ID_LOCALPART_PATTERN = re.compile(r"^@([a-zA-Z0-9._=/-]+):")
+
+# Gunicorn worker classes that can be chosen with CACTUS_WORKER_CLASS. The
+# app is preloaded, so its sockets and locks exist before a gevent or
+# eventlet worker could monkey-patch them. Those classes are not offered.
+WORKER_CLASSES = ["sync", "gthread"]
+
+# How many times to retry a request that the homeserver rate limited.
+RATE_LIMITED_RETRIES = 5
+
+# Requests to an endpoint are never paced further apart than this (seconds).
+MAX_REQUEST_INTERVAL = 10.0
+
+# A comment section being created holds a slot in the quota of its site, for
+# at most this many seconds, in case the worker creating it dies.
+ROOM_RESERVATION_SECONDS = 300.0
+
+# A sample rate changed while running applies to every worker, for this many
+# seconds by default. Then the configured rate applies again.
+PROFILE_OVERRIDE_SECONDS = 600.0
+
 
 HELP_MSG = """\
 🌵 Hi I'm here to help you with Cactus Comments (https://cactus.chat) 🌵
@@ -54,9 +118,31 @@ def create_app(
     namespace_regex,
     namespace_prefix,
     register_user_regex,
+    max_concurrency=10,
+    target_latency=2.0,
+    endpoint_concurrency=None,
+    homeserver_timeout=30.0,
+    breaker_failures=5,
+    breaker_latency=10.0,
+    breaker_probe_interval=5.0,
+    backlog_size=10_000,
+    trace_file=None,
+    trace_log_threshold=5.0,
+    profile_sample_rate=0.0,
+    profile_dir=None,
+    profile_max_files=100,
+    room_index_path=None,
+    reconcile_interval=60.0,
+    reconcile_batch_size=50,
+    pending_ban_batch_size=500,
+    hot_room_seconds=86_400.0,
+    site_room_rate=None,
+    site_room_burst=100,
+    site_max_rooms=None,
 ):
     app = Flask(__name__)
     app.register_blueprint(appservice_bp)
+    app.cli.add_command(provision_command)
     app.logger.setLevel(logging.INFO)
 
     app.config["hs_token"] = hs_token
@@ -67,26 +153,124 @@ def create_app(
     app.config["namespace"] = namespace_prefix
     app.config["register_user_regex"] = register_user_regex
 
+    # Compiled once, so forked workers share them
+    app.config["namespace_pattern"] = re.compile(namespace_regex)
+    app.config["register_user_pattern"] = re.compile(register_user_regex)
+
     app.config["auth_header"] = {"Authorization": f"Bearer {as_token}"}
 
+    # Keep-alive connections to the homeserver, not shared with other tenants
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_concurrency)
+    app.config["session"] = requests.Session()
+    app.config["session"].mount("http://", adapter)
+    app.config["session"].mount("https://", adapter)
+
+    app.config["rate_controller"] = RateController(
+        max_concurrency, target_latency, endpoint_concurrency
+    )
+
+    app.config["homeserver_timeout"] = homeserver_timeout
+
+    def replay_backlog():
+        app.logger.info("Homeserver recovered")
+        app.config["transaction_backlog"].wake()
+
+    app.config["circuit_breaker"] = CircuitBreaker(
+        homeserver + "/_matrix/client/versions",
+        breaker_failures,
+        breaker_latency,
+        breaker_probe_interval,
+        on_close=replay_backlog,
+    )
+
+    if room_index_path is None:
+        # Rooms of different appservices must not end up in the same index.
+        digest = hashlib.sha256(f"{homeserver} {user_id}".encode()).hexdigest()
+        room_index_path = os.path.join(
+            tempfile.gettempdir(), f"cactus-room-index-{digest[:16]}.sqlite3"
+        )
+    app.config["room_index"] = RoomIndex(room_index_path)
+    app.config["transaction_backlog"] = TransactionBacklog(
+        app.config["room_index"],
+        backlog_size,
+        room_index_path + ".backlog.lock",
+        breaker_probe_interval,
+    )
+    app.config["reconciler"] = None
+    if reconcile_interval:
+        app.config["reconciler"] = Reconciler(
+            reconcile_interval,
+            reconcile_batch_size,
+            pending_ban_batch_size,
+            room_index_path + ".lock",
+        )
+
+    app.config["hot_room_seconds"] = hot_room_seconds
+    app.config["admission_control"] = AdmissionControl(
+        site_room_rate, site_room_burst, site_max_rooms
+    )
+
+    app.config["trace_file"] = trace_file
+    app.config["trace_log_threshold"] = trace_log_threshold
+    app.config["profile_sample_rate"] = profile_sample_rate
+    app.config["profile_dir"] = profile_dir or tempfile.gettempdir()
+    app.config["profile_max_files"] = profile_max_files
+
     app.logger.info("Created application!")
 
     return app
 
 
-def create_app_from_env():
-    hs_token = os.getenv("CACTUS_HS_TOKEN")
-    as_token = os.getenv("CACTUS_AS_TOKEN")
-    homeserver = os.getenv("CACTUS_HOMESERVER_URL")
-    user_id = os.getenv("CACTUS_USER_ID")
-    namespace_regex = os.getenv("CACTUS_NAMESPACE_REGEX", r"#comments_.*")
-    namespace_prefix = os.getenv("CACTUS_NAMESPACE_PREFIX", "comments_")
-    register_user_regex = os.getenv("CACTUS_REGISTRATION_REGEX", r"@.*:.*")
+def create_app_from_env(env=os.environ):
+    """Create the app from the CACTUS_* variables in `env`."""
+    hs_token = env.get("CACTUS_HS_TOKEN")
+    as_token = env.get("CACTUS_AS_TOKEN")
+    homeserver = env.get("CACTUS_HOMESERVER_URL")
+    user_id = env.get("CACTUS_USER_ID")
+    namespace_regex = env.get("CACTUS_NAMESPACE_REGEX", r"#comments_.*")
+    namespace_prefix = env.get("CACTUS_NAMESPACE_PREFIX", "comments_")
+    register_user_regex = env.get("CACTUS_REGISTRATION_REGEX", r"@.*:.*")
+    max_concurrency = number_from_env(env, "CACTUS_MAX_CONCURRENCY", 10, int)
+    target_latency = number_from_env(env, "CACTUS_TARGET_LATENCY", 2.0, float)
+    endpoint_concurrency = env.get("CACTUS_ENDPOINT_CONCURRENCY", "")
+    homeserver_timeout = number_from_env(env, "CACTUS_HOMESERVER_TIMEOUT", 30.0, float)
+    breaker_failures = number_from_env(env, "CACTUS_BREAKER_FAILURES", 5, int)
+    breaker_latency = number_from_env(env, "CACTUS_BREAKER_LATENCY", 10.0, float)
+    breaker_probe_interval = number_from_env(
+        env, "CACTUS_BREAKER_PROBE_INTERVAL", 5.0, float
+    )
+    backlog_size = number_from_env(env, "CACTUS_BACKLOG_SIZE", 10_000, int)
+    trace_file = env.get("CACTUS_TRACE_FILE")
+    trace_log_threshold = number_from_env(env, "CACTUS_TRACE_LOG_THRESHOLD", 5.0, float)
+    try:
+        profile_sample_rate = float(env.get("CACTUS_PROFILE_SAMPLE_RATE", "0"))
+    except ValueError:
+        profile_sample_rate = -1.0
+    profile_dir = env.get("CACTUS_PROFILE_DIR")
+    profile_max_files = number_from_env(env, "CACTUS_PROFILE_MAX_FILES", 100, int)
+    room_index_path = env.get("CACTUS_ROOM_INDEX_PATH")
+    reconcile_interval = number_from_env(
+        env, "CACTUS_RECONCILE_INTERVAL", 60.0, float, allow_zero=True
+    )
+    reconcile_batch_size = number_from_env(env, "CACTUS_RECONCILE_BATCH_SIZE", 50, int)
+    pending_ban_batch_size = number_from_env(
+        env, "CACTUS_PENDING_BAN_BATCH_SIZE", 500, int
+    )
+    hot_room_seconds = number_from_env(env, "CACTUS_HOT_ROOM_SECONDS", 86_400.0, float)
+    site_room_rate = number_from_env(env, "CACTUS_SITE_ROOM_RATE", None, float)
+    site_room_burst = number_from_env(env, "CACTUS_SITE_ROOM_BURST", 100, int)
+    site_max_rooms = number_from_env(env, "CACTUS_SITE_MAX_ROOMS", None, int)
 
     if hs_token is None:
         print("No homeserver token provided (CACTUS_HS_TOKEN).", file=sys.stderr)
         sys.exit(CONFIG_ERROR_EXITCODE)
 
+    if room_index_path is None:
+        # The index holds pending bans and the backlog, which must survive
+        # restarts. So it should not end up in a temporary directory.
+        print("No room index path provided (CACTUS_ROOM_INDEX_PATH).", file=sys.stderr)
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
     if as_token is None:
         print("No appservice token provided (CACTUS_AS_TOKEN).", file=sys.stderr)
         sys.exit(CONFIG_ERROR_EXITCODE)
@@ -117,6 +301,34 @@ def create_app_from_env():
         print("Namespace regex should start with the namespace prefix")
         sys.exit(CONFIG_ERROR_EXITCODE)
 
+    for name, regex in [
+        ("CACTUS_NAMESPACE_REGEX", namespace_regex),
+        ("CACTUS_REGISTRATION_REGEX", register_user_regex),
+    ]:
+        try:
+            re.compile(regex)
+        except re.error as e:
+            print(f"Invalid regular expression ({name}): {e}", file=sys.stderr)
+            sys.exit(CONFIG_ERROR_EXITCODE)
+
+    if not 0 <= profile_sample_rate <= 1:
+        print(
+            "Profile sample rate should be between 0 and 1"
+            " (CACTUS_PROFILE_SAMPLE_RATE).",
+            file=sys.stderr,
+        )
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
+    try:
+        endpoint_concurrency = parse_endpoint_concurrency(endpoint_concurrency)
+    except ValueError:
+        print(
+            "Endpoint concurrency should look like `ban=4,createRoom=2`"
+            " (CACTUS_ENDPOINT_CONCURRENCY).",
+            file=sys.stderr,
+        )
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
     return create_app(
         hs_token,
         as_token,
@@ -125,9 +337,111 @@ def create_app_from_env():
         namespace_regex,
         namespace_prefix,
         register_user_regex,
+        max_concurrency,
+        target_latency,
+        endpoint_concurrency,
+        homeserver_timeout,
+        breaker_failures,
+        breaker_latency,
+        breaker_probe_interval,
+        backlog_size,
+        trace_file,
+        trace_log_threshold,
+        profile_sample_rate,
+        profile_dir,
+        profile_max_files,
+        room_index_path,
+        reconcile_interval,
+        reconcile_batch_size,
+        pending_ban_batch_size,
+        hot_room_seconds,
+        site_room_rate,
+        site_room_burst,
+        site_max_rooms,
     )
 
 
+def create_wsgi_app_from_env():
+    """Create the app, or one app per tenant if CACTUS_TENANTS_FILE is set.
+
+    The tenants file is a JSON list of objects of CACTUS_* variables, like
+    CACTUS_HS_TOKEN and CACTUS_HOMESERVER_URL. Variables of a tenant override
+    those in the environment, so settings common to all tenants can be set
+    once.
+    """
+    tenants_file = os.getenv("CACTUS_TENANTS_FILE")
+    if tenants_file is None:
+        return create_app_from_env()
+
+    try:
+        with open(tenants_file) as f:
+            tenants = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read tenants (CACTUS_TENANTS_FILE): {e}", file=sys.stderr)
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
+    if not (
+        isinstance(tenants, list)
+        and tenants
+        and all(isinstance(tenant, dict) for tenant in tenants)
+    ):
+        print(
+            "Tenants should be a non-empty list of objects (CACTUS_TENANTS_FILE).",
+            file=sys.stderr,
+        )
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
+    apps = []
+    for i, tenant in enumerate(tenants):
+        env = {**os.environ, **{name: str(value) for name, value in tenant.items()}}
+        try:
+            apps.append(create_app_from_env(env))
+        except SystemExit:
+            print(f"Invalid tenant {i} (CACTUS_TENANTS_FILE).", file=sys.stderr)
+            raise
+
+    # Requests are routed by hs_token, and sites of different tenants must
+    # not end up in the same room index.
+    for name, values in [
+        ("CACTUS_HS_TOKEN", [app.config["hs_token"] for app in apps]),
+        ("CACTUS_ROOM_INDEX_PATH", [app.config["room_index"].path for app in apps]),
+    ]:
+        if len(set(values)) != len(values):
+            print(
+                f"Tenants should not share {name} (CACTUS_TENANTS_FILE).",
+                file=sys.stderr,
+            )
+            sys.exit(CONFIG_ERROR_EXITCODE)
+
+    return TenantDispatcher(apps)
+
+
+def number_from_env(env, name, default, number_type, allow_zero=False):
+    """Read a positive number from the environment variable `name`."""
+    value = env.get(name)
+    if value is None:
+        return default
+    try:
+        number = number_type(value)
+    except ValueError:
+        number = None
+    if number is None or number < 0 or (number == 0 and not allow_zero):
+        print(f"{name} should be a positive number.", file=sys.stderr)
+        sys.exit(CONFIG_ERROR_EXITCODE)
+    return number
+
+
+def parse_endpoint_concurrency(value):
+    """Parse a string like `ban=4,createRoom=2` into a dict."""
+    endpoint_concurrency = {}
+    for budget in filter(None, value.split(",")):
+        endpoint, limit = budget.split("=")
+        endpoint_concurrency[endpoint.strip()] = int(limit)
+        if endpoint_concurrency[endpoint.strip()] <= 0:
+            raise ValueError(f"Concurrency of {endpoint} must be positive.")
+    return endpoint_concurrency
+
+
 def matrix_error(error_code, http_code, error_msg=None):
     if error_msg is None:
         current_app.logger.info("%s %s", http_code, error_code)
@@ -136,39 +450,1276 @@ def matrix_error(error_code, http_code, error_msg=None):
     return jsonify({"errcode": error_code, "error": error_msg}), http_code
 
 
+class RateController:
+    """Adaptive limits on requests to the homeserver.
+
+    Every endpoint gets its own limit on concurrent requests, and its own
+    minimum interval between the starts of requests. Both are adjusted with
+    AIMD (additive increase, multiplicative decrease) when responses are
+    slower than `target_latency` or when the homeserver rate limits us: the
+    concurrency limit is halved, and requests are paced at half the rate
+    they were recently started at. The pacing is what slows down loops that
+    send one request at a time. Fast responses raise the paced rate by one
+    request per `target_latency`, and the concurrency limit by about one per
+    window of requests. A rate limited endpoint is also paused for as long as
+    the homeserver asks us to wait.
+    """
+
+    def __init__(self, max_concurrency, target_latency, endpoint_concurrency=None):
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.endpoint_concurrency = endpoint_concurrency or {}
+        self._condition = threading.Condition()
+        self._endpoints = {}
+
+    def _endpoint(self, endpoint):
+        if endpoint not in self._endpoints:
+            max_limit = self.endpoint_concurrency.get(endpoint, self.max_concurrency)
+            self._endpoints[endpoint] = {
+                "max_limit": max_limit,
+                "limit": float(max_limit),
+                "in_flight": 0,
+                "paused_until": 0.0,
+                "interval": 0.0,
+                "last_start": 0.0,
+                "start_gap": None,
+                "last_decrease": 0.0,
+                "requests": 0,
+                "throttled": 0,
+                "throttled_seconds": 0.0,
+                "rate_limited": 0,
+                "slow": 0,
+            }
+        return self._endpoints[endpoint]
+
+    def acquire(self, endpoint):
+        """Block until a request to `endpoint` is allowed."""
+        with self._condition:
+            state = self._endpoint(endpoint)
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                ready_at = max(
+                    state["paused_until"], state["last_start"] + state["interval"]
+                )
+                if now < ready_at:
+                    self._condition.wait(ready_at - now)
+                elif state["in_flight"] >= int(state["limit"]):
+                    self._condition.wait()
+                else:
+                    break
+            waited = now - start
+            if waited > 0.001:
+                state["throttled"] += 1
+                state["throttled_seconds"] += waited
+            if state["requests"]:
+                # Moving average of the time between the starts of requests
+                gap = now - state["last_start"]
+                state["start_gap"] = (
+                    gap
+                    if state["start_gap"] is None
+                    else 0.8 * state["start_gap"] + 0.2 * gap
+                )
+            state["last_start"] = now
+            state["in_flight"] += 1
+            state["requests"] += 1
+
+    def release(self, endpoint, latency, retry_after=None):
+        """Release a request and adapt the limit to how it went.
+
+        `retry_after` is the number of seconds the homeserver asked us to
+        wait, if it rate limited the request.
+        """
+        with self._condition:
+            state = self._endpoint(endpoint)
+            state["in_flight"] -= 1
+            now = time.monotonic()
+            if retry_after is not None:
+                state["rate_limited"] += 1
+                state["paused_until"] = max(state["paused_until"], now + retry_after)
+                self._decrease(state, now)
+            elif latency > self.target_latency:
+                state["slow"] += 1
+                self._decrease(state, now)
+            elif state["interval"]:
+                rate = 1 / state["interval"] + 1 / self.target_latency
+                # Stop pacing when it would allow a thousand requests a second
+                state["interval"] = 1 / rate if rate < 1000 else 0.0
+            else:
+                state["limit"] = min(
+                    state["max_limit"], state["limit"] + 1 / state["limit"]
+                )
+            self._condition.notify_all()
+
+    def _decrease(self, state, now):
+        # Only decrease once per `target_latency`, so a burst of slow
+        # responses to concurrent requests only counts once.
+        if now - state["last_decrease"] > self.target_latency:
+            state["limit"] = max(1.0, state["limit"] / 2)
+            state["interval"] = min(
+                MAX_REQUEST_INTERVAL,
+                max(2 * state["interval"], 2 * (state["start_gap"] or 0.0)),
+            )
+            state["last_decrease"] = now
+
+    def metrics(self):
+        with self._condition:
+            return {
+                endpoint: {
+                    "limit": int(state["limit"]),
+                    "interval": round(state["interval"], 3),
+                    "in_flight": state["in_flight"],
+                    "requests": state["requests"],
+                    "throttled": state["throttled"],
+                    "throttled_seconds": round(state["throttled_seconds"], 3),
+                    "rate_limited": state["rate_limited"],
+                    "slow": state["slow"],
+                }
+                for endpoint, state in self._endpoints.items()
+            }
+
+
+class HomeserverUnavailable(Exception):
+    """The homeserver is degraded and the circuit breaker is open."""
+
+
+class RoomUnreadable(Exception):
+    """We cannot read the state of a room, for example after being kicked."""
+
+
+class CircuitBreaker:
+    """Fail fast while the homeserver is degraded.
+
+    The breaker opens after `failure_threshold` consecutive requests that
+    failed, got a 5xx response or took longer than `latency_threshold`
+    seconds. While open, requests are not sent at all, and a background
+    thread probes `probe_url` every `probe_interval` seconds. When a probe
+    succeeds the breaker closes again and `on_close` is called.
+    """
+
+    def __init__(
+        self,
+        probe_url,
+        failure_threshold,
+        latency_threshold,
+        probe_interval,
+        on_close=None,
+    ):
+        self.probe_url = probe_url
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.probe_interval = probe_interval
+        self.on_close = on_close
+        self.is_open = False
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._trips = 0
+        self._rejected = 0
+
+    def allow(self):
+        """Return whether a request may be sent to the homeserver."""
+        with self._lock:
+            if self.is_open:
+                self._rejected += 1
+            return not self.is_open
+
+    def record(self, ok, latency):
+        """Record the outcome of a request. Return True if the breaker tripped."""
+        with self._lock:
+            if ok and latency <= self.latency_threshold:
+                self._consecutive_failures = 0
+                return False
+            self._consecutive_failures += 1
+            if self.is_open or self._consecutive_failures < self.failure_threshold:
+                return False
+            self.is_open = True
+            self._trips += 1
+        threading.Thread(target=self._probe_until_recovered, daemon=True).start()
+        return True
+
+    def _probe_until_recovered(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                r = requests.get(self.probe_url, timeout=self.latency_threshold)
+            except requests.exceptions.RequestException:
+                continue
+            if r.ok:
+                break
+        with self._lock:
+            self.is_open = False
+            self._consecutive_failures = 0
+        if self.on_close is not None:
+            self.on_close()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "open": self.is_open,
+                "consecutive_failures": self._consecutive_failures,
+                "trips": self._trips,
+                "rejected": self._rejected,
+            }
+
+
+class TransactionBacklog:
+    """Events deferred while the homeserver is unavailable.
+
+    The events are kept in the room index, so they survive restarts and are
+    shared by all workers. Holds at most `max_size` events. When it is full,
+    transactions are refused instead, and the homeserver will retry them
+    later.
+
+    A background thread in every worker replays the backlog once the
+    homeserver is available, every `interval` seconds or when woken up. Only
+    the worker holding a lock on `lock_path` replays, so events are handled
+    once and in order.
+    """
+
+    def __init__(self, room_index, max_size, lock_path, interval):
+        self.room_index = room_index
+        self.max_size = max_size
+        self.lock_path = lock_path
+        self.interval = interval
+        self._pid = None
+        self._wake = threading.Event()
+
+    def __len__(self):
+        return self.room_index.count_deferred_events()
+
+    def defer(self, events, force=False):
+        """Add events to the backlog. Return False if there is no room.
+
+        With `force`, the events are added even if the backlog is full.
+        """
+        max_size = None if force else self.max_size
+        return self.room_index.defer_events(events, max_size)
+
+    def ensure_running(self, app):
+        """Start the replay thread, once in every worker process."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, args=(app,), daemon=True)
+        thread.start()
+
+    def wake(self):
+        """Replay the backlog now, for example when the homeserver recovers."""
+        self._wake.set()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with app.app_context():
+                if app.config["circuit_breaker"].is_open or not len(self):
+                    continue
+                try:
+                    self.replay(handle_event)
+                except Exception:
+                    app.logger.exception("Replaying transaction backlog failed")
+
+    def replay(self, handle_event):
+        """Handle the deferred events in order, until the backlog is empty.
+
+        Stops if the homeserver fails again, or another worker is replaying.
+        Events that fail for other reasons are logged and dropped, so they
+        do not block the backlog.
+        """
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            current_app.logger.info("Replaying transaction backlog")
+            while True:
+                deferred = self.room_index.oldest_deferred_event()
+                if deferred is None:
+                    return
+                seq, event = deferred
+                try:
+                    handle_event(event)
+                except HomeserverUnavailable:
+                    return
+                except Exception:
+                    current_app.logger.exception(
+                        "Dropping deferred event    seq=%r", seq
+                    )
+                self.room_index.remove_deferred_event(seq)
+
+
+class RoomIndex:
+    """Index of room id <-> alias <-> site, shared by all worker processes.
+
+    The index is an SQLite database in WAL mode, so reads never block and
+    any worker that observes a change can update it for everyone. Rooms
+    without a canonical alias are stored with a NULL alias, so we do not
+    look them up again. Every thread in every process gets its own
+    connection, which makes the index safe to create before forking.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS rooms (
+                    room_id TEXT PRIMARY KEY,
+                    alias TEXT,
+                    site TEXT
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS rooms_alias ON rooms (alias);
+                CREATE INDEX IF NOT EXISTS rooms_site ON rooms (site);
+                CREATE TABLE IF NOT EXISTS dirty_rooms (
+                    room_id TEXT PRIMARY KEY
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS room_activity (
+                    room_id TEXT PRIMARY KEY,
+                    last_active REAL
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS room_activity_last_active
+                    ON room_activity (last_active);
+                CREATE TABLE IF NOT EXISTS pending_bans (
+                    room_id TEXT,
+                    user_id TEXT,
+                    PRIMARY KEY (room_id, user_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS room_reservations (
+                    alias TEXT PRIMARY KEY,
+                    site TEXT,
+                    reserved REAL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS site_buckets (
+                    site TEXT PRIMARY KEY,
+                    tokens REAL,
+                    updated REAL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS backlog (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event TEXT
+                );
+                """)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def alias(self, room_id):
+        """Return (found, alias) for a room id. The alias may be None."""
+        row = (
+            self._connection()
+            .execute("SELECT alias FROM rooms WHERE room_id = ?", (room_id,))
+            .fetchone()
+        )
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    def room_id(self, alias):
+        """Return the room id of an alias, or None if it is not indexed."""
+        row = (
+            self._connection()
+            .execute("SELECT room_id FROM rooms WHERE alias = ?", (alias,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def put(self, room_id, alias, site):
+        """Index a room. An alias points to one room only, so when it moves,
+        for example after a room upgrade, the old room is forgotten.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if alias is not None:
+                connection.execute(
+                    "DELETE FROM rooms WHERE alias = ? AND room_id != ?",
+                    (alias, room_id),
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO rooms (room_id, alias, site) VALUES (?, ?, ?)",
+                (room_id, alias, site),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def mark_dirty(self, room_ids):
+        """Mark rooms that may have drifted from their moderation room."""
+        self._connection().executemany(
+            "INSERT OR IGNORE INTO dirty_rooms (room_id) VALUES (?)",
+            ((room_id,) for room_id in room_ids),
+        )
+
+    def dirty_rooms(self, limit):
+        rows = self._connection().execute(
+            "SELECT room_id FROM dirty_rooms LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    def count_dirty(self):
+        return (
+            self._connection().execute("SELECT COUNT(*) FROM dirty_rooms").fetchone()[0]
+        )
+
+    def clear_dirty(self, room_id):
+        self._connection().execute(
+            "DELETE FROM dirty_rooms WHERE room_id = ?", (room_id,)
+        )
+
+    def admit_room(self, site, alias, alias_prefix, rate, burst, max_rooms):
+        """Decide whether the comment section `alias` of a site may be created.
+
+        The quota check, the reservation of a slot in the quota, and taking a
+        token from the token bucket of the site happen in one transaction, so
+        concurrent workers cannot go past the limits. Comment sections are
+        the indexed rooms of the site with an alias starting with
+        `alias_prefix`, and the reservations of rooms being created. The
+        bucket holds up to `burst` tokens and refills with `rate` tokens per
+        second. Limits that are None are not enforced. Returns None if the
+        room may be created, or the reason it may not.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "DELETE FROM room_reservations WHERE reserved < ?",
+                (now - ROOM_RESERVATION_SECONDS,),
+            )
+            reason = None
+            if max_rooms is not None:
+                if self._count_comment_sections(site, alias, alias_prefix) >= max_rooms:
+                    reason = "quota_exceeded"
+            if reason is None and rate is not None:
+                if not self._take_token(site, rate, burst, now):
+                    reason = "rate_limited"
+            if reason is None and max_rooms is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO room_reservations (alias, site, reserved)"
+                    " VALUES (?, ?, ?)",
+                    (alias, site, now),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return reason
+
+    def _count_comment_sections(self, site, alias, alias_prefix):
+        pattern = re.sub(r"([\\%_])", r"\\\1", alias_prefix) + "%"
+        return (
+            self._connection()
+            .execute(
+                """
+                SELECT
+                    (SELECT COUNT(*) FROM rooms
+                        WHERE site = ? AND alias LIKE ? ESCAPE '\\')
+                    + (SELECT COUNT(*) FROM room_reservations
+                        WHERE site = ? AND alias != ?
+                        AND NOT EXISTS (
+                            SELECT 1 FROM rooms
+                            WHERE rooms.alias = room_reservations.alias
+                        ))
+                """,
+                (site, pattern, site, alias),
+            )
+            .fetchone()[0]
+        )
+
+    def _take_token(self, site, rate, burst, now):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT tokens, updated FROM site_buckets WHERE site = ?", (site,)
+        ).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        taken = tokens >= 1
+        if taken:
+            tokens -= 1
+        connection.execute(
+            "INSERT OR REPLACE INTO site_buckets (site, tokens, updated)"
+            " VALUES (?, ?, ?)",
+            (site, tokens, now),
+        )
+        return taken
+
+    def release_room_reservation(self, alias):
+        self._connection().execute(
+            "DELETE FROM room_reservations WHERE alias = ?", (alias,)
+        )
+
+    def touch_room(self, room_id, timestamp):
+        """Record activity in a room, at most once a minute."""
+        self._connection().execute(
+            """
+            INSERT INTO room_activity (room_id, last_active) VALUES (?, ?)
+            ON CONFLICT (room_id) DO UPDATE SET last_active = excluded.last_active
+            WHERE excluded.last_active > room_activity.last_active + 60
+            """,
+            (room_id, timestamp),
+        )
+
+    def active_rooms(self, since):
+        """Return ids of rooms active since `since`, the most recent first."""
+        rows = self._connection().execute(
+            "SELECT room_id FROM room_activity WHERE last_active >= ?"
+            " ORDER BY last_active DESC",
+            (since,),
+        )
+        return [row[0] for row in rows]
+
+    def add_pending_ban(self, room_ids, user_id):
+        self._connection().executemany(
+            "INSERT OR IGNORE INTO pending_bans (room_id, user_id) VALUES (?, ?)",
+            ((room_id, user_id) for room_id in room_ids),
+        )
+
+    def pending_bans(self, room_id):
+        rows = self._connection().execute(
+            "SELECT user_id FROM pending_bans WHERE room_id = ?", (room_id,)
+        )
+        return [row[0] for row in rows]
+
+    def some_pending_bans(self, limit):
+        """Return up to `limit` (room id, user id) pairs of pending bans."""
+        return (
+            self._connection()
+            .execute("SELECT room_id, user_id FROM pending_bans LIMIT ?", (limit,))
+            .fetchall()
+        )
+
+    def count_pending_bans(self):
+        return (
+            self._connection()
+            .execute("SELECT COUNT(*) FROM pending_bans")
+            .fetchone()[0]
+        )
+
+    def clear_pending_bans(self, room_id, user_ids):
+        self._connection().executemany(
+            "DELETE FROM pending_bans WHERE room_id = ? AND user_id = ?",
+            ((room_id, user_id) for user_id in user_ids),
+        )
+
+    def clear_site_pending_bans(self, site, user_id):
+        """Forget the pending bans of a user in all rooms of a site."""
+        self._connection().execute(
+            "DELETE FROM pending_bans WHERE user_id = ?"
+            " AND room_id IN (SELECT room_id FROM rooms WHERE site = ?)",
+            (user_id, site),
+        )
+
+    def get_meta(self, key):
+        row = (
+            self._connection()
+            .execute("SELECT value FROM meta WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def defer_events(self, events, max_size=None):
+        """Append events to the backlog, unless it would exceed `max_size`.
+
+        Returns whether the events were added.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            count = connection.execute("SELECT COUNT(*) FROM backlog").fetchone()[0]
+            added = max_size is None or count + len(events) <= max_size
+            if added:
+                connection.executemany(
+                    "INSERT INTO backlog (event) VALUES (?)",
+                    ((json.dumps(event),) for event in events),
+                )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return added
+
+    def oldest_deferred_event(self):
+        """Return (seq, event) of the oldest event in the backlog, or None."""
+        row = (
+            self._connection()
+            .execute("SELECT seq, event FROM backlog ORDER BY seq LIMIT 1")
+            .fetchone()
+        )
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def remove_deferred_event(self, seq):
+        self._connection().execute("DELETE FROM backlog WHERE seq = ?", (seq,))
+
+    def count_deferred_events(self):
+        return self._connection().execute("SELECT COUNT(*) FROM backlog").fetchone()[0]
+
+
+class Reconciler:
+    """Repair rooms that have drifted from the moderation room of their site.
+
+    Bans and power levels are replicated from moderation rooms when events
+    are pushed to us, but those writes can fail. Rooms with failed writes
+    are marked dirty in the room index, and so are rooms where an
+    incremental /sync shows ban or power level changes by someone other than
+    us. Every `interval` seconds, up to `batch_size` dirty rooms are compared
+    to their moderation room and repaired. The sync token is kept in the room
+    index, so work is proportional to the changes since the last run, also
+    across restarts. Then up to `pending_ban_batch_size` bans of inactive
+    rooms are applied, whether or not the repairs succeeded.
+
+    Only one worker runs the reconciler at a time, the one holding a lock on
+    `lock_path`.
+    """
+
+    def __init__(self, interval, batch_size, pending_ban_batch_size, lock_path):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending_ban_batch_size = pending_ban_batch_size
+        self.lock_path = lock_path
+        self.is_leader = False
+        self.repaired_rooms = 0
+        self.failed_rooms = 0
+        self._pid = None
+        self._lock_file = None
+
+    def ensure_running(self, app):
+        """Start the reconciler thread, once in every worker process."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.is_leader = False
+        self._lock_file = None
+        thread = threading.Thread(target=self._run, args=(app,), daemon=True)
+        thread.start()
+
+    def _try_lead(self):
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _run(self, app):
+        while True:
+            time.sleep(self.interval)
+            with app.app_context():
+                try:
+                    self.is_leader = self.is_leader or self._try_lead()
+                    if self.is_leader:
+                        self.reconcile()
+                except HomeserverUnavailable:
+                    app.logger.info("Homeserver unavailable, reconciling later")
+                except Exception:
+                    app.logger.exception("Reconciling failed")
+
+    def reconcile(self):
+        """Mark rooms that changed since the last sync, repair a batch, and
+        apply a batch of pending bans.
+        """
+        try:
+            self.sync()
+            self.repair_dirty_rooms()
+        except HomeserverUnavailable:
+            raise
+        except Exception:
+            # Bans of inactive rooms have the lowest priority, but they must
+            # not wait for repairs that fail.
+            current_app.logger.exception("Repairing rooms failed")
+        apply_pending_bans(self.pending_ban_batch_size)
+
+    def repair_dirty_rooms(self):
+        room_index = current_app.config["room_index"]
+        mod_room_states = {}
+        for room_id in room_index.dirty_rooms(self.batch_size):
+            # Cleared before repairing, so writes that fail during the repair
+            # mark the room dirty again.
+            room_index.clear_dirty(room_id)
+            try:
+                if repair_room(room_id, mod_room_states):
+                    self.repaired_rooms += 1
+            except HomeserverUnavailable:
+                room_index.mark_dirty([room_id])
+                raise
+            except Exception:
+                # Retrying would block the rooms after this one forever
+                current_app.logger.exception(
+                    "Could not repair room, giving up on it    room_id=%r", room_id
+                )
+                self.failed_rooms += 1
+
+    def sync(self):
+        room_index = current_app.config["room_index"]
+        token_key = f"sync_token {current_app.config['user_id']}"
+        since = room_index.get_meta(token_key)
+        if since is None:
+            # Start from now. There is no need to look at the past, which
+            # would mean the state of every room.
+            params = {"filter": json.dumps(EMPTY_SYNC_FILTER)}
+        else:
+            params = {
+                "since": since,
+                "timeout": 0,
+                "filter": json.dumps(RECONCILE_SYNC_FILTER),
+            }
+        r = homeserver_request("GET", "/sync", endpoint="sync", params=params)
+        if not r.ok:
+            current_app.logger.warning("Sync failed    status=%r", r.status_code)
+            return
+        sync = r.json()
+        if since is not None:
+            for room_id, room in sync.get("rooms", {}).get("join", {}).items():
+                events = room.get("state", {}).get("events", []) + room.get(
+                    "timeline", {}
+                ).get("events", [])
+                # Our own writes are replicated from a moderation room
+                # already. Moderation rooms are the source of truth, and
+                # their changes reach comment sections when pushed to us.
+                if any(
+                    is_moderation_event(event)
+                    and event.get("sender") != current_app.config["user_id"]
+                    for event in events
+                ):
+                    room_index.mark_dirty([room_id])
+        room_index.set_meta(token_key, sync["next_batch"])
+
+    def metrics(self):
+        return {
+            "leader": self.is_leader,
+            "dirty_rooms": current_app.config["room_index"].count_dirty(),
+            "repaired_rooms": self.repaired_rooms,
+            "failed_rooms": self.failed_rooms,
+            "pending_bans": current_app.config["room_index"].count_pending_bans(),
+        }
+
+
+class AdmissionControl:
+    """Per-site limits on the creation of comment sections.
+
+    Every site has a token bucket, which allows a burst of `burst` rooms and
+    refills with `rate` rooms per second. Sites can have at most `max_rooms`
+    comment sections. Limits that are None are not enforced. The buckets and
+    the quota live in the room index, so they are shared by all workers. An
+    admitted room holds a slot in the quota until it is released, after the
+    room was created or failed to.
+    """
+
+    def __init__(self, rate=None, burst=100, max_rooms=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_rooms = max_rooms
+        self._lock = threading.Lock()
+        self._sites = collections.defaultdict(collections.Counter)
+
+    def admit(self, site, alias):
+        """Return None if a room may be created, or the reason it may not."""
+        reason = None
+        if self.rate is not None or self.max_rooms is not None:
+            reason = current_app.config["room_index"].admit_room(
+                site,
+                alias,
+                f"#{current_app.config['namespace']}{site}_",
+                self.rate,
+                self.burst,
+                self.max_rooms,
+            )
+        with self._lock:
+            self._sites[site][reason or "admitted"] += 1
+        return reason
+
+    def release(self, alias):
+        """Release the slot in the quota, held by an admitted room."""
+        if self.max_rooms is not None:
+            current_app.config["room_index"].release_room_reservation(alias)
+
+    def metrics(self):
+        with self._lock:
+            return {site: dict(counter) for site, counter in self._sites.items()}
+
+
+def is_moderation_event(event):
+    """Return whether an event changes bans or power levels."""
+    if event["type"] == "m.room.power_levels":
+        return True
+    return (
+        event["type"] == "m.room.member"
+        and event.get("content", {}).get("membership") == "ban"
+    )
+
+
+def repair_room(room_id, mod_room_states):
+    """Make a comment section agree with its moderation room.
+
+    The moderation room is the source of truth: its bans and power levels
+    are copied to the comment section, never the other way around. Unbans
+    are not replicated, so copying bans up would undo them. `mod_room_states`
+    caches the state of moderation rooms. Returns whether anything was
+    repaired.
+    """
+    alias = canonical_room_alias(room_id)
+    if alias is None or not is_comment_section_room(alias):
+        return False
+    mod_room_id = mod_room_id_from_alias(alias)
+    if mod_room_id is None:
+        return False
+    if mod_room_id not in mod_room_states:
+        mod_room_states[mod_room_id] = get_room_state(mod_room_id)
+    mod_banned_users, mod_power_levels = mod_room_states[mod_room_id]
+    banned_users, power_levels = get_room_state(room_id)
+
+    repaired = False
+    if mod_banned_users - banned_users:
+        ban_users(room_id, mod_banned_users - banned_users)
+        repaired = True
+    if mod_power_levels is not None and power_levels != mod_power_levels:
+        set_power_levels(room_id, mod_power_levels)
+        repaired = True
+    if repaired:
+        current_app.logger.info("Repaired drifted room    room=%r", alias)
+    return repaired
+
+
+def rate_limit_retry_after(r):
+    """Return the seconds to wait, if the response is M_LIMIT_EXCEEDED."""
+    if r.status_code != 429:
+        return None
+    try:
+        retry_after_ms = r.json().get("retry_after_ms", 1000)
+    except ValueError:
+        retry_after_ms = 1000
+    return retry_after_ms / 1000
+
+
+def homeserver_request(method, path, endpoint, **kwargs):
+    """Send a request to the client-server API of the homeserver.
+
+    All outbound traffic goes through the rate controller. `endpoint` names
+    the budget the request counts against. Requests that are rate limited by
+    the homeserver are retried, so writes like bans are not lost.
+
+    Raises HomeserverUnavailable if the request fails, the circuit breaker
+    is open, or the request is still rate limited after all retries.
+    """
+    controller = current_app.config["rate_controller"]
+    breaker = current_app.config["circuit_breaker"]
+    url = current_app.config["homeserver"] + "/_matrix/client/r0" + path
+    kwargs.setdefault("timeout", current_app.config["homeserver_timeout"])
+    for attempt in range(RATE_LIMITED_RETRIES + 1):
+        if not breaker.allow():
+            raise HomeserverUnavailable(endpoint)
+        controller.acquire(endpoint)
+        start = time.monotonic()
+        with trace_span("homeserver", endpoint=endpoint, path=path) as span:
+            try:
+                r = current_app.config["session"].request(
+                    method, url, headers=current_app.config["auth_header"], **kwargs
+                )
+            except requests.exceptions.RequestException as e:
+                span["status"] = "unavailable"
+                latency = time.monotonic() - start
+                controller.release(endpoint, latency)
+                record_homeserver_outcome(breaker, endpoint, False, latency)
+                raise HomeserverUnavailable(endpoint) from e
+            span["status"] = r.status_code
+        latency = time.monotonic() - start
+        retry_after = rate_limit_retry_after(r)
+        controller.release(endpoint, latency, retry_after)
+        record_homeserver_outcome(breaker, endpoint, r.status_code < 500, latency)
+        if retry_after is None:
+            return r
+        current_app.logger.info(
+            "Rate limited by homeserver    endpoint=%r retry_after=%r attempt=%r",
+            endpoint,
+            retry_after,
+            attempt,
+        )
+    current_app.logger.warning(
+        "Giving up on rate limited request    endpoint=%r path=%r", endpoint, path
+    )
+    raise HomeserverUnavailable(endpoint)
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    """Record a span in the trace of the current request.
+
+    Yields the span, so the caller can add attributes like the status. Does
+    nothing outside of traced requests.
+    """
+    spans = g.get("trace_spans") if has_app_context() else None
+    span = {"name": name, **attributes}
+    if spans is None:
+        yield span
+        return
+    start = time.monotonic()
+    span["start_ms"] = round((start - g.trace_start) * 1000, 2)
+    spans.append(span)
+    try:
+        yield span
+    finally:
+        span["duration_ms"] = round((time.monotonic() - start) * 1000, 2)
+
+
+def export_trace(trace):
+    """Log slow traces and append every trace to the trace file, if any."""
+    if trace["duration_ms"] >= current_app.config["trace_log_threshold"] * 1000:
+        current_app.logger.info("Slow request    trace=%s", json.dumps(trace))
+    trace_file = current_app.config["trace_file"]
+    if trace_file is not None:
+        with open(trace_file, "a") as f:
+            f.write(json.dumps(trace) + "\n")
+
+
+def profile_sample_rate():
+    """Return the fraction of requests to profile.
+
+    A rate changed at /_cactus/v1/profiling is kept in the room index, so all
+    workers use it, until it expires.
+    """
+    override = current_app.config["room_index"].get_meta("profile_sample_rate")
+    if override is not None:
+        sample_rate, until = json.loads(override)
+        if time.time() < until:
+            return sample_rate
+    return current_app.config["profile_sample_rate"]
+
+
+def may_dump_profile():
+    """Whether `profile_dir` has room for another profile."""
+    try:
+        names = os.listdir(current_app.config["profile_dir"])
+    except OSError:
+        return False
+    dumped = sum(1 for n in names if n.startswith("cactus-") and n.endswith(".prof"))
+    return dumped < current_app.config["profile_max_files"]
+
+
+def traced(f):
+    """Trace the request, and sometimes capture a CPU profile of it.
+
+    Every event handled and every homeserver request is recorded as a span,
+    see `trace_span`. A fraction of requests, see `profile_sample_rate`, is
+    profiled with cProfile, and the stats are dumped to `profile_dir`, until
+    it holds `profile_max_files` profiles.
+    """
+
+    @wraps(f)
+    def inner(*args, **kwargs):
+        g.trace_start = time.monotonic()
+        g.trace_spans = []
+        profiler = None
+        if random.random() < profile_sample_rate() and may_dump_profile():
+            profiler = cProfile.Profile()
+            profiler.enable()
+        # Unhandled exceptions end up as a 500
+        status = 500
+        try:
+            try:
+                response = f(*args, **kwargs)
+            except Exception as e:
+                # Error handlers, like the one for HomeserverUnavailable,
+                # respond here, so the trace has the status the client got.
+                response = current_app.handle_user_exception(e)
+            response = make_response(response)
+            status = response.status_code
+            return response
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profile_path = os.path.join(
+                    current_app.config["profile_dir"],
+                    f"cactus-{f.__name__}-{os.getpid()}-{time.time_ns()}.prof",
+                )
+                profiler.dump_stats(profile_path)
+                current_app.logger.info("Profiled request    path=%r", profile_path)
+            duration = time.monotonic() - g.trace_start
+            export_trace(
+                {
+                    "view": f.__name__,
+                    "path": request.path,
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 2),
+                    "spans": g.pop("trace_spans"),
+                }
+            )
+
+    return inner
+
+
+def record_homeserver_outcome(breaker, endpoint, ok, latency):
+    if breaker.record(ok, latency):
+        current_app.logger.warning(
+            "Homeserver degraded, circuit breaker opened    endpoint=%r", endpoint
+        )
+
+
 def send_plaintext_msg(room_id, msg):
     txn_id = random.randint(0, 1_000_000_000)
-    return requests.put(
-        current_app.config["homeserver"]
-        + f"/_matrix/client/r0/rooms/{room_id}/send/m.room.message/{txn_id}",
-        headers=current_app.config["auth_header"],
+    return homeserver_request(
+        "PUT",
+        f"/rooms/{room_id}/send/m.room.message/{txn_id}",
+        endpoint="send",
         json={"msgtype": "m.text", "body": msg},
     )
 
 
-def alias_to_mod_room_id(alias):
-    """Convert any room alias to the mod room id for its' site."""
+def room_id_from_alias(alias):
+    """Look up the room id of a room alias in the room directory."""
+    quoted_alias = urllib.parse.quote(alias)
+    return homeserver_request(
+        "GET",
+        f"/directory/room/{quoted_alias}",
+        endpoint="directory",
+    )
+
+
+def mod_room_id_from_alias(alias):
+    """Return the mod room id for the site of any room alias.
+
+    Returns None if the site does not exist.
+    """
     splitting_colon = alias.index(":")
     last_underscore = alias.rindex("_", 0, splitting_colon)
-    mod_alias = urllib.parse.quote(alias[:last_underscore] + alias[splitting_colon:])
-    return requests.get(
-        current_app.config["homeserver"]
-        + f"/_matrix/client/r0/directory/room/{mod_alias}",
-        headers=current_app.config["auth_header"],
+    return moderation_room_id(alias[:last_underscore] + alias[splitting_colon:])
+
+
+def moderation_room_id(mod_alias):
+    """Return the room id of a moderation room alias, or None."""
+    mod_room_id = current_app.config["room_index"].room_id(mod_alias)
+    if mod_room_id is not None:
+        return mod_room_id
+    r = room_id_from_alias(mod_alias)
+    if r.status_code >= 500:
+        raise HomeserverUnavailable("directory")
+    if not r.ok:
+        return None
+    mod_room_id = r.json()["room_id"]
+    index_room(mod_room_id, mod_alias)
+    return mod_room_id
+
+
+def get_power_levels(room_id):
+    return homeserver_request(
+        "GET",
+        f"/rooms/{room_id}/state/m.room.power_levels",
+        endpoint="power_levels",
+    )
+
+
+def get_room_state(room_id):
+    """Return the banned users and the power levels of a room.
+
+    Raises RoomUnreadable if the homeserver does not let us read the state.
+    """
+    r = homeserver_request(
+        "GET",
+        f"/rooms/{room_id}/state",
+        endpoint="state",
+    )
+    if r.status_code >= 500:
+        raise HomeserverUnavailable("state")
+    if not r.ok:
+        raise RoomUnreadable(room_id, r.status_code)
+    banned_users = set()
+    power_levels = None
+    for state in r.json():
+        if state["type"] == "m.room.power_levels":
+            power_levels = state["content"]
+        elif state["type"] == "m.room.member":
+            if state["content"]["membership"] == "ban":
+                banned_users.add(state["state_key"])
+    return banned_users, power_levels
+
+
+def get_banned_users(room_id):
+    """Return the user ids of everyone banned from a room."""
+    banned_users, _ = get_room_state(room_id)
+    return banned_users
+
+
+def ban_users(room_id, user_ids):
+    # Send ban events, one at a time...
+    for user_id in user_ids:
+        r = homeserver_request(
+            "POST",
+            f"/rooms/{room_id}/ban",
+            endpoint="ban",
+            json={"user_id": user_id},
+        )
+        if not r.ok:
+            mark_room_drifted(room_id, r)
+
+
+def set_power_levels(room_id, power_levels):
+    r = homeserver_request(
+        "PUT",
+        f"/rooms/{room_id}/state/m.room.power_levels",
+        endpoint="power_levels",
+        json=power_levels,
     )
+    if not r.ok:
+        mark_room_drifted(room_id, r)
+
+
+def replicate_ban(room_ids, user_id):
+    """Ban a user from comment sections, the most active ones first.
+
+    Rooms with messages within the last `hot_room_seconds` are banned from
+    right away. For the other rooms, the ban is left pending. It is applied
+    when the room sees a message, or by the reconciler in the background,
+    whichever comes first.
+    """
+    room_index = current_app.config["room_index"]
+    since = time.time() - current_app.config["hot_room_seconds"]
+    room_ids = set(room_ids)
+    hot_room_ids = [r for r in room_index.active_rooms(since) if r in room_ids]
+    for room_id in hot_room_ids:
+        ban_users(room_id, [user_id])
+    cold_room_ids = room_ids.difference(hot_room_ids)
+    if current_app.config["reconciler"] is None:
+        # Nothing sweeps pending bans, so ban right away
+        for room_id in cold_room_ids:
+            ban_users(room_id, [user_id])
+    else:
+        room_index.add_pending_ban(cold_room_ids, user_id)
+    current_app.logger.info(
+        "Replicated ban    user=%r hot_rooms=%r pending_rooms=%r",
+        user_id,
+        len(hot_room_ids),
+        len(cold_room_ids),
+    )
+
+
+def previous_membership(event):
+    """Return the membership a member event replaced, if known."""
+    prev_content = event.get("unsigned", {}).get("prev_content")
+    if prev_content is None:
+        # Older homeservers put it at the top level
+        prev_content = event.get("prev_content") or {}
+    return prev_content.get("membership")
+
+
+def note_room_activity(room_id, event):
+    """Remember when a room was last active, and apply its pending bans."""
+    room_index = current_app.config["room_index"]
+    timestamp = event.get("origin_server_ts", time.time() * 1000) / 1000
+    room_index.touch_room(room_id, timestamp)
+    pending_bans = room_index.pending_bans(room_id)
+    if pending_bans:
+        ban_users(room_id, pending_bans)
+        room_index.clear_pending_bans(room_id, pending_bans)
+
+
+def apply_pending_bans(limit):
+    """Apply up to `limit` pending bans, in the background."""
+    room_index = current_app.config["room_index"]
+    for room_id, user_id in room_index.some_pending_bans(limit):
+        ban_users(room_id, [user_id])
+        room_index.clear_pending_bans(room_id, [user_id])
+
+
+def mark_room_drifted(room_id, r):
+    """Let the reconciler repair a room, that we failed to update."""
+    current_app.logger.warning(
+        "Failed to update room, marking it for repair    room_id=%r status=%r",
+        room_id,
+        r.status_code,
+    )
+    current_app.config["room_index"].mark_dirty([room_id])
+
+
+def create_comment_section_room(alias_localpart, power_levels):
+    """Create a comment section room for the alias localpart.
+
+    `power_levels` is the power level content of the site moderation room.
+    Returns the response of the `createRoom` call, which fails with
+    M_ROOM_IN_USE if the comment section already exists.
+    """
+    sitename = sitename_from_localpart(alias_localpart)
+    comment_section_id = comment_section_id_from_localpart(alias_localpart)
+    r = homeserver_request(
+        "POST",
+        "/createRoom",
+        endpoint="createRoom",
+        json={
+            "visibility": "private",
+            "name": f"{sitename} comment section ({comment_section_id})",
+            "room_alias_name": alias_localpart[1:],  # strip leading hashtag
+            "creation_content": {"m.federate": True},
+            "initial_state": [
+                # Make the room public to whoever knows the link.
+                {
+                    "type": "m.room.join_rules",
+                    "content": {"join_rule": "public"},
+                },
+                # Allow guests to join the room.
+                {
+                    "type": "m.room.guest_access",
+                    "content": {"guest_access": "can_join"},
+                },
+                # Make future room history visible to anyone.
+                {
+                    "type": "m.room.history_visibility",
+                    "content": {"history_visibility": "world_readable"},
+                },
+            ],
+            # Replicate power level from site moderation room
+            "power_level_content_override": power_levels,
+        },
+    )
+    if r.ok:
+        server_name = server_name_from_user_id(current_app.config["user_id"])
+        index_room(r.json()["room_id"], f"{alias_localpart}:{server_name}")
+    return r
 
 
-@lru_cache(maxsize=None)
 def canonical_room_alias(room_id):
     """Get the canonical room alias (or None) from a room id."""
-    r = requests.get(
-        current_app.config["homeserver"]
-        + f"/_matrix/client/r0/rooms/{room_id}/state/m.room.canonical_alias",
-        headers=current_app.config["auth_header"],
+    found, alias = current_app.config["room_index"].alias(room_id)
+    if found:
+        return alias
+    r = homeserver_request(
+        "GET",
+        f"/rooms/{room_id}/state/m.room.canonical_alias",
+        endpoint="canonical_alias",
     )
-    if not r.ok or "alias" not in r.json():
+    if r.ok:
+        alias = r.json().get("alias")
+    elif r.status_code == 404 and r.json().get("errcode") == "M_NOT_FOUND":
+        alias = None
+    else:
+        # Maybe we are not in the room yet. Do not remember the room as
+        # having no alias, the index is shared and survives restarts.
         return None
-    return r.json()["alias"]
+    index_room(room_id, alias)
+    return alias
+
+
+def index_room(room_id, alias):
+    """Add a room to the shared room index."""
+    site = None
+    if alias is not None and current_app.config["namespace_pattern"].match(alias):
+        alias_localpart = localpart_from_alias(alias)
+        if is_comment_section_room(alias):
+            site = sitename_from_localpart(alias_localpart)
+        elif is_moderation_room(alias):
+            site = alias_localpart[len(current_app.config["namespace"]) + 1 :]
+    current_app.config["room_index"].put(room_id, alias, site)
 
 
 def is_comment_section_room(alias):
@@ -181,8 +1732,7 @@ def is_comment_section_room(alias):
 def is_moderation_room(alias):
     if current_app.config["namespace"].count("_") != alias.count("_"):
         return False
-    namespace_regex = current_app.config["namespace_regex"]
-    return re.match(namespace_regex, alias) is not None
+    return current_app.config["namespace_pattern"].match(alias) is not None
 
 
 def authorization_required(f):
@@ -210,8 +1760,11 @@ def authorization_required(f):
 
 
 def localpart_from_user_id(user_id):
-    # https://matrix.org/docs/spec/appendices#user-identifiers
-    return re.match(r"^@([a-zA-Z0-9._=/-]+):", user_id).group(1)
+    return USER_ID_LOCALPART_PATTERN.match(user_id).group(1)
+
+
+def server_name_from_user_id(user_id):
+    return user_id.split(":", 1)[1]
 
 
 def localpart_from_alias(alias):
@@ -233,7 +1786,13 @@ def comment_section_id_from_localpart(alias_localpart):
 
 
 def is_user_allowed_register(user_id):
-    return re.match(current_app.config["register_user_regex"], user_id) is not None
+    return current_app.config["register_user_pattern"].match(user_id) is not None
+
+
+def make_sure_reconciler_is_running():
+    reconciler = current_app.config["reconciler"]
+    if reconciler is not None:
+        reconciler.ensure_running(current_app._get_current_object())
 
 
 def make_sure_user_is_registered():
@@ -248,14 +1807,15 @@ def make_sure_user_is_registered():
         current_app.logger.info("Registering user    user_id=%r", user_id)
 
         # Register user
-        r = requests.post(
-            current_app.config["homeserver"] + "/_matrix/client/r0/register",
+        r = homeserver_request(
+            "POST",
+            "/register",
+            endpoint="register",
             json={
                 "username": localpart_from_user_id(user_id),
                 "type": "m.login.application_service",
             },
             params={"kind": "user"},
-            headers=current_app.config["auth_header"],
         )
         if not (r.ok or r.json()["errcode"] == "M_USER_IN_USE"):
             raise ValueError("Failed to register user.")
@@ -264,28 +1824,28 @@ def make_sure_user_is_registered():
 
         # Change display name
         try:
-            requests.put(
-                current_app.config["homeserver"]
-                + f"/_matrix/client/r0/profile/{user_id}/displayname",
+            homeserver_request(
+                "PUT",
+                f"/profile/{user_id}/displayname",
+                endpoint="profile",
                 json={"displayname": "Cactus Comments"},
-                headers=current_app.config["auth_header"],
                 timeout=5,
             )
-        except requests.exceptions.Timeout:
+        except HomeserverUnavailable:
             current_app.logger.info("Setting display name timed out.")
 
         current_app.logger.info("Setting profile image")
 
         # Change avatar / profile image
         try:
-            requests.put(
-                current_app.config["homeserver"]
-                + f"/_matrix/client/r0/profile/{user_id}/avatar_url",
+            homeserver_request(
+                "PUT",
+                f"/profile/{user_id}/avatar_url",
+                endpoint="profile",
                 json={"avatar_url": "mxc://matrix.org/gdgXnTHPpGqCsIPAaUNgoHHV"},
-                headers=current_app.config["auth_header"],
                 timeout=5,
             )
-        except requests.exceptions.Timeout:
+        except HomeserverUnavailable:
             current_app.logger.info("Setting profile image timed out.")
 
         current_app.config["registered"] = True
@@ -293,120 +1853,147 @@ def make_sure_user_is_registered():
         current_app.logger.info("Registration complete")
 
 
-@appservice_bp.route("/transactions/<string:txn_id>", methods=["PUT"])  # deprecated
-@appservice_bp.route("/_matrix/app/v1/transactions/<string:txn_id>", methods=["PUT"])
+@appservice_bp.route("/_cactus/v1/metrics", methods=["GET"])
 @authorization_required
-def new_transaction(txn_id: str):
-    """Implement the Push API from the appservice specification.
+def metrics():
+    """Report how outbound homeserver traffic is throttled."""
+    reconciler = current_app.config["reconciler"]
+    return jsonify(
+        {
+            "rate_controller": current_app.config["rate_controller"].metrics(),
+            "circuit_breaker": current_app.config["circuit_breaker"].metrics(),
+            "transaction_backlog": len(current_app.config["transaction_backlog"]),
+            "reconciler": reconciler.metrics() if reconciler else None,
+            "admission_control": current_app.config["admission_control"].metrics(),
+        }
+    )
 
-    The homeserver hits this endpoint to notify us of new events in our rooms.
 
-    Reference: https://matrix.org/docs/spec/application_service/r0.1.2#put-matrix-app-v1-transactions-txnid
+@appservice_bp.route("/_cactus/v1/profiling", methods=["GET", "PUT"])
+@authorization_required
+def profiling():
+    """Read or change the fraction of requests profiled by all workers.
+
+    A changed rate applies for `duration` seconds, then the configured rate
+    applies again.
     """
+    if request.method == "PUT":
+        body = request.get_json(silent=True) or {}
+        sample_rate = body.get("sample_rate")
+        duration = body.get("duration", PROFILE_OVERRIDE_SECONDS)
+        if not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1:
+            return matrix_error(
+                "CHAT.CACTUS.APPSERVICE_BAD_REQUEST",
+                400,
+                "sample_rate should be a number between 0 and 1.",
+            )
+        if not isinstance(duration, (int, float)) or duration <= 0:
+            return matrix_error(
+                "CHAT.CACTUS.APPSERVICE_BAD_REQUEST",
+                400,
+                "duration should be a positive number of seconds.",
+            )
+        current_app.config["room_index"].set_meta(
+            "profile_sample_rate", json.dumps([sample_rate, time.time() + duration])
+        )
+        current_app.logger.info(
+            "Profile sample rate changed    rate=%r duration=%r", sample_rate, duration
+        )
+    return jsonify(
+        {
+            "sample_rate": profile_sample_rate(),
+            "profile_dir": current_app.config["profile_dir"],
+            "max_files": current_app.config["profile_max_files"],
+        }
+    )
 
-    make_sure_user_is_registered()
 
-    events = request.get_json()["events"]
+@appservice_bp.app_errorhandler(HomeserverUnavailable)
+def homeserver_unavailable(e):
+    return matrix_error(
+        "CHAT.CACTUS.APPSERVICE_UNAVAILABLE",
+        503,
+        "The homeserver is unavailable, try again later.",
+    )
 
-    for event in events:
-        room_id = event["room_id"]
-        if event["type"] == "m.room.member":
-            is_invite = event["content"]["membership"] == "invite"
-            is_for_me = event["state_key"] == current_app.config["user_id"]
-            if is_invite and is_for_me:
-                if is_user_allowed_register(event["sender"]):
-                    current_app.logger.info(
-                        "Accepting invite    room_id=%r sender=%r",
-                        room_id,
-                        event["sender"],
-                    )
-                    # Accept invite / join room
-                    r = requests.post(
-                        current_app.config["homeserver"]
-                        + f"/_matrix/client/r0/rooms/{room_id}/join",
-                        headers=current_app.config["auth_header"],
-                        json={},
-                    )
-                else:
-                    current_app.logger.info(
-                        "Rejecting invite    room_id=%r sender=%r",
-                        room_id,
-                        event["sender"],
-                    )
-                    # Reject invite
-                    r = requests.post(
-                        current_app.config["homeserver"]
-                        + f"/_matrix/client/r0/rooms/{room_id}/leave",
-                        headers=current_app.config["auth_header"],
-                        json={},
-                    )
 
-            elif event["content"]["membership"] == "ban":
-                alias = canonical_room_alias(event["room_id"])
-                if not alias:
-                    continue
-                if is_comment_section_room(alias):
-                    # Make sure the user is also banned in the moderation room
-                    r_mod_room = alias_to_mod_room_id(alias)
-                    room_id = r_mod_room.json()["room_id"]
-                    user_to_ban = event["state_key"]
-                    requests.post(
-                        current_app.config["homeserver"]
-                        + f"/_matrix/client/r0/rooms/{room_id}/ban",
-                        headers=current_app.config["auth_header"],
-                        json={"user_id": user_to_ban},
-                    )
-                elif is_moderation_room(alias):
-                    # Ban event in a moderation room. Replicate to all rooms
-                    # for this site.
-
-                    # At this point it is very clear that our current
-                    # implementation architecture does not scale.. :-)
-
-                    mod_alias = alias  # for readability below
-                    user_to_ban = event["state_key"]
-                    current_app.logger.info(
-                        "Ban in mod room, replicating    room=%r user_to_ban=%r",
-                        mod_alias,
+def handle_event(event):
+    """Handle a single event pushed to us by the homeserver."""
+    room_id = event["room_id"]
+    if event["type"] == "m.room.member":
+        is_invite = event["content"]["membership"] == "invite"
+        is_for_me = event["state_key"] == current_app.config["user_id"]
+        if is_invite and is_for_me:
+            if is_user_allowed_register(event["sender"]):
+                current_app.logger.info(
+                    "Accepting invite    room_id=%r sender=%r",
+                    room_id,
+                    event["sender"],
+                )
+                # Accept invite / join room
+                r = homeserver_request(
+                    "POST",
+                    f"/rooms/{room_id}/join",
+                    endpoint="join",
+                    json={},
+                )
+            else:
+                current_app.logger.info(
+                    "Rejecting invite    room_id=%r sender=%r",
+                    room_id,
+                    event["sender"],
+                )
+                # Reject invite
+                r = homeserver_request(
+                    "POST",
+                    f"/rooms/{room_id}/leave",
+                    endpoint="leave",
+                    json={},
+                )
+
+        elif event["content"]["membership"] == "ban":
+            alias = canonical_room_alias(event["room_id"])
+            if not alias:
+                return
+            if is_comment_section_room(alias):
+                # Make sure the user is also banned in the moderation room
+                room_id = mod_room_id_from_alias(alias)
+                if room_id is None:
+                    return
+                user_to_ban = event["state_key"]
+                r = homeserver_request(
+                    "POST",
+                    f"/rooms/{room_id}/ban",
+                    endpoint="ban",
+                    json={"user_id": user_to_ban},
+                )
+                if not r.ok:
+                    current_app.logger.warning(
+                        "Failed to ban in mod room    room_id=%r user=%r status=%r",
+                        room_id,
                         user_to_ban,
+                        r.status_code,
                     )
-                    joined_rooms = requests.get(
-                        current_app.config["homeserver"]
-                        + "/_matrix/client/r0/joined_rooms",
-                        headers=current_app.config["auth_header"],
-                    ).json()["joined_rooms"]
-                    for room_id in joined_rooms:
-                        room_alias = canonical_room_alias(room_id)
-                        if not room_alias:
-                            continue
-                        room_alias_localpart = localpart_from_alias(room_alias)
-                        mod_alias_localpart = localpart_from_alias(mod_alias)
-                        if room_alias != mod_alias and room_alias_localpart.startswith(
-                            mod_alias_localpart
-                        ):
-                            requests.post(
-                                current_app.config["homeserver"]
-                                + f"/_matrix/client/r0/rooms/{room_id}/ban",
-                                headers=current_app.config["auth_header"],
-                                json={"user_id": user_to_ban},
-                            )
-
-        elif event["type"] == "m.room.power_levels":
-            mod_alias = canonical_room_alias(event["room_id"])
-            if not mod_alias:
-                continue
-            if is_moderation_room(mod_alias):
+            elif is_moderation_room(alias):
+                # Ban event in a moderation room. Replicate to all rooms
+                # for this site.
+
+                # At this point it is very clear that our current
+                # implementation architecture does not scale.. :-)
+
+                mod_alias = alias  # for readability below
+                user_to_ban = event["state_key"]
                 current_app.logger.info(
-                    "Power level changed, replicating    room=%r", mod_alias
+                    "Ban in mod room, replicating    room=%r user_to_ban=%r",
+                    mod_alias,
+                    user_to_ban,
                 )
-                # When power_levels are changed in the moderation room, we want
-                # to replicate it to all rooms for the site
-                power_levels = event["content"]
-                joined_rooms = requests.get(
-                    current_app.config["homeserver"]
-                    + "/_matrix/client/r0/joined_rooms",
-                    headers=current_app.config["auth_header"],
+                joined_rooms = homeserver_request(
+                    "GET",
+                    "/joined_rooms",
+                    endpoint="joined_rooms",
                 ).json()["joined_rooms"]
+                site_room_ids = []
                 for room_id in joined_rooms:
                     room_alias = canonical_room_alias(room_id)
                     if not room_alias:
@@ -416,111 +2003,209 @@ def new_transaction(txn_id: str):
                     if room_alias != mod_alias and room_alias_localpart.startswith(
                         mod_alias_localpart
                     ):
-                        requests.put(
-                            current_app.config["homeserver"]
-                            + f"/_matrix/client/r0/rooms/{room_id}/state/m.room.power_levels",
-                            headers=current_app.config["auth_header"],
-                            json=power_levels,
-                        )
-
-        elif event["type"] == "m.room.message":
-            if event["content"].get("msgtype") != "m.text":
-                continue
-            msg = event["content"]["body"]
-            if not (msg == "help" or msg.startswith("register")):
-                # Only react to "help" and "register <sitename>" messages
-                continue
-
-            # Only interact with anyone in the `CACTUS_REGISTRATION_REGEX`
-            if not is_user_allowed_register(event["sender"]):
-                continue
+                        site_room_ids.append(room_id)
+                replicate_ban(site_room_ids, user_to_ban)
+
+        elif (
+            event["content"]["membership"] == "leave"
+            and previous_membership(event) == "ban"
+        ):
+            alias = canonical_room_alias(event["room_id"])
+            if alias and is_moderation_room(alias):
+                # Unbans are not replicated, but bans that are still pending
+                # must not be applied anymore.
+                site = localpart_from_alias(alias)[
+                    len(current_app.config["namespace"]) + 1 :
+                ]
+                current_app.config["room_index"].clear_site_pending_bans(
+                    site, event["state_key"]
+                )
+                current_app.logger.info(
+                    "Unban in mod room, cleared pending bans    room=%r user=%r",
+                    alias,
+                    event["state_key"],
+                )
 
-            # Make sure we don't respond to comments
-            alias = canonical_room_alias(room_id)
-            if alias:
-                namespace_regex = current_app.config["namespace_regex"]
-                if re.match(namespace_regex, alias) is not None:
+    elif event["type"] == "m.room.power_levels":
+        mod_alias = canonical_room_alias(event["room_id"])
+        if not mod_alias:
+            return
+        if is_moderation_room(mod_alias):
+            current_app.logger.info(
+                "Power level changed, replicating    room=%r", mod_alias
+            )
+            # When power_levels are changed in the moderation room, we want
+            # to replicate it to all rooms for the site
+            power_levels = event["content"]
+            joined_rooms = homeserver_request(
+                "GET",
+                "/joined_rooms",
+                endpoint="joined_rooms",
+            ).json()["joined_rooms"]
+            for room_id in joined_rooms:
+                room_alias = canonical_room_alias(room_id)
+                if not room_alias:
                     continue
+                room_alias_localpart = localpart_from_alias(room_alias)
+                mod_alias_localpart = localpart_from_alias(mod_alias)
+                if room_alias != mod_alias and room_alias_localpart.startswith(
+                    mod_alias_localpart
+                ):
+                    set_power_levels(room_id, power_levels)
+
+    elif event["type"] == "m.room.canonical_alias":
+        # Keep the room index up to date for all workers
+        index_room(room_id, event["content"].get("alias"))
+
+    elif event["type"] == "m.room.message":
+        note_room_activity(room_id, event)
+
+        if event["content"].get("msgtype") != "m.text":
+            return
+        msg = event["content"]["body"]
+        if not (msg == "help" or msg.startswith("register")):
+            # Only react to "help" and "register <sitename>" messages
+            return
+
+        # Only interact with anyone in the `CACTUS_REGISTRATION_REGEX`
+        if not is_user_allowed_register(event["sender"]):
+            return
+
+        # Make sure we don't respond to comments
+        alias = canonical_room_alias(room_id)
+        if alias:
+            if current_app.config["namespace_pattern"].match(alias) is not None:
+                return
+
+        if msg == "help":
+            send_plaintext_msg(room_id, HELP_MSG)
+            return
+
+        command = msg.split(" ")
+        if len(command) != 2:
+            error_msg = 'To register a site, type "register <sitename>"'
+            send_plaintext_msg(room_id, error_msg)
+            return
+
+        sitename = command[1]
+
+        if not sitename:
+            error_msg = 'To register a site, type "register <sitename>"'
+            send_plaintext_msg(room_id, error_msg)
+            return
+
+        if "_" in sitename:
+            error_msg = 'Sorry, underscore ("_") is not allowed in site names'
+            send_plaintext_msg(room_id, error_msg)
+            return
+
+        # Try to create, will fail if already exists
+        r = homeserver_request(
+            "POST",
+            "/createRoom",
+            endpoint="createRoom",
+            json={
+                "visibility": "private",
+                "room_alias_name": current_app.config["namespace"] + sitename,
+                "name": f"{sitename} moderation room",
+                "topic": f"Moderation room for {sitename}. For more, visit https://cactus.chat",
+                "invite": [event["sender"]],
+                "creation_content": {"m.federate": True},
+                "initial_state": [
+                    # Make the room invite only.
+                    {
+                        "type": "m.room.join_rules",
+                        "content": {"join_rule": "invite"},
+                    },
+                    # Make future room history visible to members since
+                    # they were invited.
+                    {
+                        "type": "m.room.history_visibility",
+                        "content": {"history_visibility": "invited"},
+                    },
+                ],
+                # Make sender admin in new room
+                "power_level_content_override": {
+                    "users": {
+                        event["sender"]: 100,
+                        current_app.config["user_id"]: 100,
+                    }
+                },
+            },
+        )
+        rjson = r.json()
+
+        if not r.ok:
+            errcode = rjson.get("errcode", "")
+            if errcode == "M_ROOM_IN_USE":
+                msg = f"Sorry, {sitename} is already used by someone else."
+                send_plaintext_msg(room_id, msg)
+                return
+            else:
+                error_msg = rjson.get("error", "no error message")
+                current_app.logger.warning(
+                    "Failed to create site with unknown error    error=%r",
+                    error_msg,
+                )
+                msg = f"Unknown error. Error from homeserver: {error_msg}."
+                send_plaintext_msg(room_id, msg)
+                return
 
-            if msg == "help":
-                send_plaintext_msg(room_id, HELP_MSG)
-                continue
+        current_app.logger.info(
+            "Created site    name=%r owner=%r", sitename, event["sender"]
+        )
 
-            command = msg.split(" ")
-            if len(command) != 2:
-                error_msg = 'To register a site, type "register <sitename>"'
-                send_plaintext_msg(room_id, error_msg)
-                continue
+        send_plaintext_msg(room_id, f"Created site {sitename} for you 🚀")
+        send_plaintext_msg(rjson["room_id"], MODERATION_EXPLANATION)
 
-            sitename = command[1]
 
-            if not sitename:
-                error_msg = 'To register a site, type "register <sitename>"'
-                send_plaintext_msg(room_id, error_msg)
-                continue
+@appservice_bp.route("/transactions/<string:txn_id>", methods=["PUT"])  # deprecated
+@appservice_bp.route("/_matrix/app/v1/transactions/<string:txn_id>", methods=["PUT"])
+@authorization_required
+@traced
+def new_transaction(txn_id: str):
+    """Implement the Push API from the appservice specification.
 
-            if "_" in sitename:
-                error_msg = 'Sorry, underscore ("_") is not allowed in site names'
-                send_plaintext_msg(room_id, error_msg)
-                continue
+    The homeserver hits this endpoint to notify us of new events in our rooms.
 
-            # Try to create, will fail if already exists
-            r = requests.post(
-                current_app.config["homeserver"] + "/_matrix/client/r0/createRoom",
-                headers=current_app.config["auth_header"],
-                json={
-                    "visibility": "private",
-                    "room_alias_name": current_app.config["namespace"] + sitename,
-                    "name": f"{sitename} moderation room",
-                    "topic": f"Moderation room for {sitename}. For more, visit https://cactus.chat",
-                    "invite": [event["sender"]],
-                    "creation_content": {"m.federate": True},
-                    "initial_state": [
-                        # Make the room invite only.
-                        {
-                            "type": "m.room.join_rules",
-                            "content": {"join_rule": "invite"},
-                        },
-                        # Make future room history visible to members since
-                        # they were invited.
-                        {
-                            "type": "m.room.history_visibility",
-                            "content": {"history_visibility": "invited"},
-                        },
-                    ],
-                    # Make sender admin in new room
-                    "power_level_content_override": {
-                        "users": {
-                            event["sender"]: 100,
-                            current_app.config["user_id"]: 100,
-                        }
-                    },
-                },
-            )
-            rjson = r.json()
+    Reference: https://matrix.org/docs/spec/application_service/r0.1.2#put-matrix-app-v1-transactions-txnid
+    """
 
-            if not r.ok:
-                errcode = rjson.get("errcode", "")
-                if errcode == "M_ROOM_IN_USE":
-                    msg = f"Sorry, {sitename} is already used by someone else."
-                    send_plaintext_msg(room_id, msg)
-                    continue
-                else:
-                    error_msg = rjson.get("error", "no error message")
-                    current_app.logger.warning(
-                        "Failed to create site with unknown error    error=%r",
-                        error_msg,
-                    )
-                    msg = f"Unknown error. Error from homeserver: {error_msg}."
-                    send_plaintext_msg(room_id, msg)
-                    continue
+    make_sure_user_is_registered()
+    make_sure_reconciler_is_running()
+
+    events = request.get_json()["events"]
+
+    # While the homeserver is unavailable, events are deferred to a backlog
+    # which is replayed in the background when it recovers. New events queue
+    # up behind the backlog to keep them in order.
+    backlog = current_app.config["transaction_backlog"]
+    backlog.ensure_running(current_app._get_current_object())
+    if len(backlog) or current_app.config["circuit_breaker"].is_open:
+        if not backlog.defer(events):
+            # Nothing was handled, so the homeserver can retry the whole
+            # transaction later.
+            raise HomeserverUnavailable()
+        current_app.logger.info(
+            "Deferred events to backlog    txn_id=%r events=%r", txn_id, len(events)
+        )
+        return jsonify({}), 200
 
+    for i, event in enumerate(events):
+        try:
+            with trace_span("event", type=event["type"], room_id=event["room_id"]):
+                handle_event(event)
+        except HomeserverUnavailable:
+            # The events before this one were handled, so the transaction
+            # must not be retried. The backlog may grow past its size by
+            # the rest of this transaction.
+            backlog.defer(events[i:], force=True)
             current_app.logger.info(
-                "Created site    name=%r owner=%r", sitename, event["sender"]
+                "Deferred events to backlog    txn_id=%r events=%r",
+                txn_id,
+                len(events) - i,
             )
-
-            send_plaintext_msg(room_id, f"Created site {sitename} for you 🚀")
-            send_plaintext_msg(rjson["room_id"], MODERATION_EXPLANATION)
+            break
 
     return jsonify({}), 200
 
@@ -528,6 +2213,7 @@ def new_transaction(txn_id: str):
 @appservice_bp.route("/rooms/<path:alias>", methods=["GET"])  # deprecated
 @appservice_bp.route("/_matrix/app/v1/rooms/<path:alias>", methods=["GET"])
 @authorization_required
+@traced
 def query_room_alias(alias: str):
     """Implement the Room Alias Query API from the appservice specification.
 
@@ -539,60 +2225,48 @@ def query_room_alias(alias: str):
     """
 
     make_sure_user_is_registered()
+    make_sure_reconciler_is_running()
 
     if not is_comment_section_room(alias):
         return matrix_error("CHAT.CACTUS.APPSERVICE_NOT_FOUND", 404)
 
-    r_mod_id = alias_to_mod_room_id(alias)
-    if not r_mod_id.ok:
+    mod_room_id = mod_room_id_from_alias(alias)
+    if mod_room_id is None:
         # Site does not exist.
         return matrix_error("CHAT.CACTUS.APPSERVICE_NOT_FOUND", 404)
 
+    # Limit how fast, and how many, comment sections a site can get.
+    # The moderation room is usually known from the room index, so this is
+    # decided before asking the homeserver for anything.
+    alias_localpart = localpart_from_alias(alias)
+    sitename = sitename_from_localpart(alias_localpart)
+    admission_control = current_app.config["admission_control"]
+    rejection = admission_control.admit(sitename, alias)
+    if rejection == "rate_limited":
+        return matrix_error(
+            "CHAT.CACTUS.APPSERVICE_RATE_LIMITED",
+            429,
+            f"Too many new comment sections for {sitename}, try again later.",
+        )
+    if rejection == "quota_exceeded":
+        return matrix_error(
+            "CHAT.CACTUS.APPSERVICE_QUOTA_EXCEEDED",
+            403,
+            f"{sitename} has reached its maximum number of comment sections.",
+        )
+
     # Now we know that this is a query for a valid comment section room. We
     # must create it, if it does not exist.
 
-    mod_room_id = r_mod_id.json()["room_id"]
+    try:
+        # Get power levels from moderation room
+        r_power_level = get_power_levels(mod_room_id)
 
-    # Get power levels from moderation room
-    r_power_level = requests.get(
-        current_app.config["homeserver"]
-        + f"/_matrix/client/r0/rooms/{mod_room_id}/state/m.room.power_levels",
-        headers=current_app.config["auth_header"],
-    )
-
-    # Create room
-    alias_localpart = localpart_from_alias(alias)
-    sitename = sitename_from_localpart(alias_localpart)
-    comment_section_id = comment_section_id_from_localpart(alias_localpart)
-    r = requests.post(
-        current_app.config["homeserver"] + "/_matrix/client/r0/createRoom",
-        headers=current_app.config["auth_header"],
-        json={
-            "visibility": "private",
-            "name": f"{sitename} comment section ({comment_section_id})",
-            "room_alias_name": alias_localpart[1:],  # strip leading hashtag
-            "creation_content": {"m.federate": True},
-            "initial_state": [
-                # Make the room public to whoever knows the link.
-                {
-                    "type": "m.room.join_rules",
-                    "content": {"join_rule": "public"},
-                },
-                # Allow guests to join the room.
-                {
-                    "type": "m.room.guest_access",
-                    "content": {"guest_access": "can_join"},
-                },
-                # Make future room history visible to anyone.
-                {
-                    "type": "m.room.history_visibility",
-                    "content": {"history_visibility": "world_readable"},
-                },
-            ],
-            # Replicate power level from site moderation room
-            "power_level_content_override": r_power_level.json(),
-        },
-    )
+        # Create room
+        r = create_comment_section_room(alias_localpart, r_power_level.json())
+    finally:
+        # Once created, the room is counted from the room index instead
+        admission_control.release(alias)
 
     if not r.ok:
         if r.json().get("errcode") == "M_ROOM_IN_USE":
@@ -609,24 +2283,250 @@ def query_room_alias(alias: str):
             f"Unknown error. Error from homeserver: {homeserver_err_msg}.",
         )
 
-    # Get banned users from moderation room
-    r_banned_users = requests.get(
-        current_app.config["homeserver"]
-        + f"/_matrix/client/r0/rooms/{mod_room_id}/state",
-        headers=current_app.config["auth_header"],
-    )
-    # Send ban events, one at a time...
-    room_id = r.json()["room_id"]
-    for state in r_banned_users.json():
-        if state["type"] != "m.room.member":
-            continue
-        if state["content"]["membership"] == "ban":
-            requests.post(
-                current_app.config["homeserver"]
-                + f"/_matrix/client/r0/rooms/{room_id}/ban",
-                headers=current_app.config["auth_header"],
-                json={"user_id": state["state_key"]},
-            )
+    # Replicate bans from moderation room
+    ban_users(r.json()["room_id"], get_banned_users(mod_room_id))
 
     # 200, with an empty json object indicates that the room exists.
     return jsonify({}), 200
+
+
+def comment_section_ids_from_sitemap(sitemap_file):
+    """Return the path of every <loc> in a sitemap as comment section ids."""
+    ids = []
+    for element in ET.parse(sitemap_file).iter():
+        # Ignore XML namespaces, sitemaps are usually namespaced.
+        if element.tag.rsplit("}", 1)[-1] != "loc" or not element.text:
+            continue
+        path = urllib.parse.urlsplit(element.text.strip()).path.strip("/")
+        ids.append(path)
+    return ids
+
+
+@click.command("provision")
+@click.argument("sitename")
+@click.argument("comment_section_ids", nargs=-1)
+@click.option(
+    "--ids-file",
+    type=click.File("r"),
+    help="File with one comment section id per line.",
+)
+@click.option(
+    "--sitemap",
+    type=click.File("rb"),
+    help="Sitemap XML file. The URL path of every <loc> is a comment section id.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Parallel requests.",
+)
+@click.option(
+    "--rate",
+    type=click.FloatRange(min=0, min_open=True),
+    default=5.0,
+    show_default=True,
+    help="Max rooms created per second.",
+)
+@click.option(
+    "--state-file",
+    type=click.Path(dir_okay=False),
+    help="Records finished ids, so an interrupted run can be resumed.",
+)
+@with_appcontext
+def provision_command(
+    sitename, comment_section_ids, ids_file, sitemap, concurrency, rate, state_file
+):
+    """Create comment sections for SITENAME ahead of time.
+
+    Rooms are created with the same settings as when they are created on the
+    first visit. Comment sections that already exist are skipped.
+    """
+    app = current_app._get_current_object()
+    make_sure_user_is_registered()
+
+    ids = list(comment_section_ids)
+    if ids_file is not None:
+        ids.extend(line.strip() for line in ids_file)
+    if sitemap is not None:
+        ids.extend(comment_section_ids_from_sitemap(sitemap))
+
+    finished = set()
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file) as f:
+            finished = {line.rstrip("\n") for line in f}
+
+    todo = []
+    previously_finished = 0
+    for comment_section_id in dict.fromkeys(ids):  # deduplicate, keep order
+        if not comment_section_id:
+            continue
+        if comment_section_id in finished:
+            previously_finished += 1
+            continue
+        if "_" in comment_section_id or ":" in comment_section_id:
+            click.echo(f"Skipping invalid comment section id {comment_section_id!r}")
+            continue
+        todo.append(comment_section_id)
+
+    server_name = server_name_from_user_id(app.config["user_id"])
+    site_localpart = f"#{app.config['namespace']}{sitename}"
+    mod_room_id = moderation_room_id(f"{site_localpart}:{server_name}")
+    if mod_room_id is None:
+        raise click.ClickException(f"Site {sitename} does not exist.")
+
+    # Every comment section gets the same power levels and bans, so we only
+    # fetch them once.
+    power_levels = get_power_levels(mod_room_id).json()
+    banned_users = get_banned_users(mod_room_id)
+
+    lock = threading.Lock()
+    next_start = time.monotonic()
+    counts = {"created": 0, "existing": 0, "failed": 0}
+    state = open(state_file, "a") if state_file is not None else None
+
+    def wait_for_turn():
+        nonlocal next_start
+        with lock:
+            now = time.monotonic()
+            start = max(now, next_start)
+            next_start = start + 1 / rate
+        time.sleep(start - now)
+
+    def create(alias_localpart):
+        r = create_comment_section_room(alias_localpart, power_levels)
+        if r.ok:
+            ban_users(r.json()["room_id"], banned_users)
+            return "created"
+        if r.json().get("errcode") == "M_ROOM_IN_USE":
+            return "existing"
+        current_app.logger.warning(
+            "Failed to provision comment section    alias=%r error=%r",
+            alias_localpart,
+            r.json().get("error", "no error message"),
+        )
+        return "failed"
+
+    def provision(comment_section_id):
+        wait_for_turn()
+        alias_localpart = f"{site_localpart}_{comment_section_id}"
+        with app.app_context():
+            try:
+                result = create(alias_localpart)
+            except HomeserverUnavailable:
+                app.logger.warning(
+                    "Homeserver unavailable, could not provision    alias=%r",
+                    alias_localpart,
+                )
+                result = "failed"
+        with lock:
+            counts[result] += 1
+            if state is not None and result != "failed":
+                state.write(comment_section_id + "\n")
+                state.flush()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Consume the iterator to propagate exceptions.
+            list(executor.map(provision, todo))
+    finally:
+        if state is not None:
+            state.close()
+
+    click.echo(
+        f"Created {counts['created']}, already existed {counts['existing']}, "
+        f"failed {counts['failed']}, previously finished {previously_finished}."
+    )
+
+
+class Launcher(BaseApplication):
+    """Serve an already created app with gunicorn.
+
+    The app is created before the workers are forked (`preload_app`), so
+    configuration is validated once and the workers share everything created
+    at startup copy-on-write.
+    """
+
+    def __init__(self, app, options, started_at):
+        self.application = app
+        self.options = options
+        self.started_at = started_at
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("preload_app", True)
+        self.cfg.set("when_ready", self.when_ready)
+        self.cfg.set("post_worker_init", self.post_worker_init)
+
+    def load(self):
+        return self.application
+
+    def when_ready(self, server):
+        self.application.logger.info(
+            "Listening    bind=%r startup_seconds=%.3f",
+            self.options["bind"],
+            time.monotonic() - self.started_at,
+        )
+
+    def post_worker_init(self, worker):
+        self.application.logger.info(
+            "Worker ready    pid=%r seconds_since_start=%.3f",
+            worker.pid,
+            time.monotonic() - self.started_at,
+        )
+
+
+class TenantDispatcher:
+    """WSGI app serving several appservice registrations in one process.
+
+    Every tenant is a separate app with its own homeserver, connection pool,
+    rate controller, circuit breaker and room index. Requests are routed by
+    the `access_token` the homeserver presents. Requests without a known
+    token go to the first tenant, which rejects them like a single app would.
+    """
+
+    def __init__(self, apps):
+        self.apps = {app.config["hs_token"]: app for app in apps}
+        self.default_app = apps[0]
+        self.logger = self.default_app.logger
+
+    def __call__(self, environ, start_response):
+        query = urllib.parse.parse_qs(environ.get("QUERY_STRING", ""))
+        hs_token = query.get("access_token", [None])[0]
+        app = self.apps.get(hs_token, self.default_app)
+        return app(environ, start_response)
+
+
+def launcher_options_from_env():
+    """Read the gunicorn options from the environment."""
+    worker_class = os.getenv("CACTUS_WORKER_CLASS", "sync")
+    if worker_class not in WORKER_CLASSES:
+        print(
+            f"Worker class should be one of {', '.join(WORKER_CLASSES)}"
+            " (CACTUS_WORKER_CLASS).",
+            file=sys.stderr,
+        )
+        sys.exit(CONFIG_ERROR_EXITCODE)
+
+    return {
+        "bind": os.getenv("CACTUS_BIND", "0.0.0.0:5000"),
+        "workers": number_from_env(os.environ, "CACTUS_WORKERS", 4, int),
+        "worker_class": worker_class,
+        "threads": number_from_env(os.environ, "CACTUS_THREADS", 1, int),
+        "timeout": number_from_env(os.environ, "CACTUS_WORKER_TIMEOUT", 500, int),
+    }
+
+
+def main():
+    """Run the appservice in production, configured by the environment."""
+    started_at = time.monotonic()
+    options = launcher_options_from_env()
+    app = create_wsgi_app_from_env()
+    Launcher(app, options, started_at).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,29 @@
+import json
 import os
 import pytest
 import random
 import requests
 import uuid
 import time
-
-from app import create_app_from_env
+from werkzeug.test import Client
+
+from app import (
+    AdmissionControl,
+    Launcher,
+    RateController,
+    ban_users,
+    canonical_room_alias,
+    create_app,
+    create_app_from_env,
+    create_wsgi_app_from_env,
+    get_room_state,
+    handle_event,
+    index_room,
+    launcher_options_from_env,
+    repair_room,
+    room_id_from_alias,
+    set_power_levels,
+)
 
 
 # this decorator makes it run once at startup
@@ -221,3 +239,532 @@ def test_unauthorized_push_api_call_empty_token(appservice):
     )
     assert r.status_code == 401
     assert r.get_json() == {"errcode": "CHAT.CACTUS.APPSERVICE_UNAUTHORIZED"}
+
+
+def test_provision_comment_sections(sitename, tmp_path):
+    app = create_app_from_env()
+    runner = app.test_cli_runner()
+    state_file = tmp_path / "provisioned"
+
+    args = ["provision", sitename, "post1", "post2", "--state-file", str(state_file)]
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert "Created 2, already existed 0" in result.output
+    assert sorted(state_file.read_text().splitlines()) == ["post1", "post2"]
+
+    # Resuming skips finished comment sections
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0, result.output
+    assert (
+        "Created 0, already existed 0, failed 0, previously finished 2" in result.output
+    )
+
+    # Comment sections that already exist are skipped
+    result = runner.invoke(args=["provision", sitename, "post1"])
+    assert result.exit_code == 0, result.output
+    assert "Created 0, already existed 1" in result.output
+
+
+def test_provision_unknown_site():
+    app = create_app_from_env()
+    result = app.test_cli_runner().invoke(args=["provision", "nosuchsite", "post1"])
+    assert result.exit_code != 0
+    assert "does not exist" in result.output
+
+
+def test_metrics(appservice, sitename):
+    appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_metrics:localhost:8008"
+    )
+    r = appservice.authorized_request("/_cactus/v1/metrics")
+    assert r.status_code == 200
+    create_room = r.get_json()["rate_controller"]["createRoom"]
+    assert create_room["requests"] >= 1
+    assert create_room["in_flight"] == 0
+
+
+def test_rate_controller_paces_sequential_requests():
+    controller = RateController(max_concurrency=10, target_latency=0.01)
+    for _ in range(5):
+        controller.acquire("ban")
+        time.sleep(0.02)
+        controller.release("ban", latency=0.02)
+    ban = controller.metrics()["ban"]
+    assert ban["interval"] > 0
+    assert ban["throttled"] > 0
+
+
+def test_unauthorized_metrics(appservice):
+    r = appservice.get("/_cactus/v1/metrics")
+    assert r.status_code == 401
+    assert r.get_json() == {"errcode": "CHAT.CACTUS.APPSERVICE_UNAUTHORIZED"}
+
+
+def create_unavailable_app(**kwargs):
+    """Create an appservice with a homeserver that refuses all connections."""
+    return create_app(
+        "hs_token",
+        "as_token",
+        "http://localhost:1",
+        "@cactusbot:localhost:8008",
+        r"#comments_.*",
+        "comments_",
+        r"@.*:.*",
+        breaker_failures=1,
+        breaker_probe_interval=60,
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def unavailable_appservice(tmp_path):
+    app = create_unavailable_app(room_index_path=str(tmp_path / "index.sqlite3"))
+    app.config["registered"] = True
+    with app.test_client() as c:
+        yield c
+
+
+def test_query_room_alias_homeserver_unavailable(unavailable_appservice):
+    r = unavailable_appservice.get(
+        "/_matrix/app/v1/rooms/%23comments_site_post:localhost:8008",
+        query_string={"access_token": "hs_token"},
+    )
+    assert r.status_code == 503
+    assert r.get_json()["errcode"] == "CHAT.CACTUS.APPSERVICE_UNAVAILABLE"
+
+
+def test_push_api_homeserver_unavailable_defers(unavailable_appservice):
+    ban = {
+        "type": "m.room.member",
+        "room_id": "!room:localhost:8008",
+        "sender": "@dev1:localhost:8008",
+        "state_key": "@spammer:localhost:8008",
+        "content": {"membership": "ban"},
+    }
+    r = unavailable_appservice.put(
+        "/_matrix/app/v1/transactions/42",
+        query_string={"access_token": "hs_token"},
+        json={"events": [ban]},
+    )
+    assert r.status_code == 200
+    r = unavailable_appservice.get(
+        "/_cactus/v1/metrics", query_string={"access_token": "hs_token"}
+    )
+    assert r.get_json()["circuit_breaker"]["open"]
+    assert r.get_json()["transaction_backlog"] == 1
+
+
+def test_push_api_full_backlog_refuses_transaction(tmp_path):
+    app = create_unavailable_app(
+        backlog_size=1, room_index_path=str(tmp_path / "index.sqlite3")
+    )
+    app.config["registered"] = True
+    message = {
+        "type": "m.room.message",
+        "room_id": "!room:localhost:8008",
+        "sender": "@dev1:localhost:8008",
+        "content": {"msgtype": "m.text", "body": "help"},
+    }
+    with app.test_client() as c:
+        r = c.put(
+            "/_matrix/app/v1/transactions/42",
+            query_string={"access_token": "hs_token"},
+            json={"events": [message]},
+        )
+        assert r.status_code == 200
+        # Refused as a whole, so the homeserver can retry it
+        r = c.put(
+            "/_matrix/app/v1/transactions/43",
+            query_string={"access_token": "hs_token"},
+            json={"events": [message, message]},
+        )
+        assert r.status_code == 503
+    assert len(app.config["transaction_backlog"]) == 1
+
+
+def test_backlog_replayed_in_order(tmp_path):
+    room_index_path = str(tmp_path / "index.sqlite3")
+    app = create_unavailable_app(room_index_path=room_index_path)
+    events = [{"type": "m.room.message", "seq": i} for i in range(3)]
+    with app.app_context():
+        assert app.config["transaction_backlog"].defer(events)
+
+    # The backlog survives restarts
+    app = create_unavailable_app(room_index_path=room_index_path)
+    handled = []
+    with app.app_context():
+        app.config["transaction_backlog"].replay(handled.append)
+    assert handled == events
+    assert len(app.config["transaction_backlog"]) == 0
+
+
+def test_trace_file(unavailable_appservice, tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    unavailable_appservice.application.config["trace_file"] = str(trace_file)
+    unavailable_appservice.get(
+        "/_matrix/app/v1/rooms/%23comments_site_post:localhost:8008",
+        query_string={"access_token": "hs_token"},
+    )
+    trace = json.loads(trace_file.read_text())
+    assert trace["view"] == "query_room_alias"
+    assert trace["status"] == 503
+    assert trace["spans"][0]["name"] == "homeserver"
+    assert trace["spans"][0]["endpoint"] == "directory"
+    assert trace["spans"][0]["status"] == "unavailable"
+
+
+def test_profiling(appservice):
+    r = appservice.authorized_request(
+        "/_cactus/v1/profiling", method="PUT", json={"sample_rate": 1}
+    )
+    assert r.status_code == 200
+    assert r.get_json()["sample_rate"] == 1
+    r = appservice.authorized_request(
+        "/_cactus/v1/profiling", method="PUT", json={"sample_rate": 2}
+    )
+    assert r.status_code == 400
+    r = appservice.authorized_request(
+        "/_cactus/v1/profiling", method="PUT", json={"sample_rate": 0}
+    )
+    assert r.status_code == 200
+
+
+def test_profiling_shared_and_capped(tmp_path):
+    room_index_path = str(tmp_path / "rooms.sqlite3")
+    profile_dir = tmp_path / "profiles"
+    profile_dir.mkdir()
+    app1, app2 = [
+        create_unavailable_app(
+            room_index_path=room_index_path,
+            profile_dir=str(profile_dir),
+            profile_max_files=2,
+        )
+        for _ in range(2)
+    ]
+    query = {"access_token": "hs_token"}
+
+    # The rate changed in one worker applies to the others
+    r = app1.test_client().put(
+        "/_cactus/v1/profiling", query_string=query, json={"sample_rate": 1}
+    )
+    assert r.status_code == 200
+    client = app2.test_client()
+    assert (
+        client.get("/_cactus/v1/profiling", query_string=query).json["sample_rate"] == 1
+    )
+
+    for _ in range(3):
+        client.get(
+            "/_matrix/app/v1/rooms/%23comments_site_post:localhost:8008",
+            query_string=query,
+        )
+    assert len(list(profile_dir.glob("cactus-*.prof"))) == 2
+
+    # Until it expires
+    r = app1.test_client().put(
+        "/_cactus/v1/profiling",
+        query_string=query,
+        json={"sample_rate": 1, "duration": 0.01},
+    )
+    time.sleep(0.02)
+    assert (
+        client.get("/_cactus/v1/profiling", query_string=query).json["sample_rate"] == 0
+    )
+
+
+def test_room_index_shared(tmp_path):
+    room_index_path = str(tmp_path / "rooms.sqlite3")
+    app1 = create_unavailable_app(room_index_path=room_index_path)
+    app2 = create_unavailable_app(room_index_path=room_index_path)
+
+    with app1.app_context():
+        index_room("!room:localhost:8008", "#comments_site_post:localhost:8008")
+        index_room("!noalias:localhost:8008", None)
+
+    # The homeserver is unavailable, so these can only come from the index
+    with app2.app_context():
+        alias = canonical_room_alias("!room:localhost:8008")
+        assert alias == "#comments_site_post:localhost:8008"
+        assert canonical_room_alias("!noalias:localhost:8008") is None
+        room_index = app2.config["room_index"]
+        assert room_index.room_id(alias) == "!room:localhost:8008"
+
+
+def test_room_index_alias_moves(unavailable_appservice):
+    app = unavailable_appservice.application
+    with app.app_context():
+        # The room is upgraded, and the alias moved to the new room
+        alias = "#comments_site_post:localhost:8008"
+        index_room("!old:localhost:8008", alias)
+        index_room("!new:localhost:8008", alias)
+
+        room_index = app.config["room_index"]
+        assert room_index.room_id(alias) == "!new:localhost:8008"
+        assert room_index.alias("!old:localhost:8008") == (False, None)
+        assert room_index.alias("!new:localhost:8008") == (True, alias)
+
+
+def test_repair_drifted_room(appservice, sitename):
+    appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_drift:localhost:8008"
+    )
+    with appservice.application.app_context():
+        alias = f"#comments_{sitename}_drift:localhost:8008"
+        room_id = room_id_from_alias(alias).json()["room_id"]
+        assert not repair_room(room_id, {})
+
+        # Demote the site owner in the comment section only
+        _, power_levels = get_room_state(room_id)
+        del power_levels["users"]["@dev1:localhost:8008"]
+        set_power_levels(room_id, power_levels)
+
+        assert repair_room(room_id, {})
+        _, power_levels = get_room_state(room_id)
+        assert power_levels["users"]["@dev1:localhost:8008"] == 100
+
+        # Bans are never copied from a comment section to the moderation room
+        ban_users(room_id, ["@dev2:localhost:8008"])
+        assert not repair_room(room_id, {})
+        mod_alias = f"#comments_{sitename}:localhost:8008"
+        mod_room_id = room_id_from_alias(mod_alias).json()["room_id"]
+        assert "@dev2:localhost:8008" not in get_room_state(mod_room_id)[0]
+
+
+def test_reconcile_skips_unreadable_rooms(appservice, sitename):
+    app = appservice.application
+    with app.app_context():
+        room_ids = []
+        for name in ["drift", "cold"]:
+            appservice.authorized_request(
+                f"/_matrix/app/v1/rooms/%23comments_{sitename}_{name}:localhost:8008"
+            )
+            alias = f"#comments_{sitename}_{name}:localhost:8008"
+            room_ids.append(room_id_from_alias(alias).json()["room_id"])
+        drift_room_id, cold_room_id = room_ids
+
+        # A room we were kicked from, or that no longer exists
+        gone_room_id = "!gone:localhost:8008"
+        index_room(gone_room_id, f"#comments_{sitename}_gone:localhost:8008")
+        room_index = app.config["room_index"]
+        room_index.mark_dirty([gone_room_id, drift_room_id])
+        room_index.add_pending_ban([cold_room_id], "@dev3:localhost:8008")
+
+        app.config["reconciler"].reconcile()
+        assert room_index.dirty_rooms(10) == []
+        assert room_index.pending_bans(cold_room_id) == []
+        assert "@dev3:localhost:8008" in get_room_state(cold_room_id)[0]
+
+
+def test_reconcile_applies_pending_bans_when_repairs_fail(
+    appservice, sitename, monkeypatch
+):
+    app = appservice.application
+    with app.app_context():
+        appservice.authorized_request(
+            f"/_matrix/app/v1/rooms/%23comments_{sitename}_cold:localhost:8008"
+        )
+        alias = f"#comments_{sitename}_cold:localhost:8008"
+        room_id = room_id_from_alias(alias).json()["room_id"]
+        room_index = app.config["room_index"]
+        room_index.add_pending_ban([room_id], "@dev2:localhost:8008")
+        room_index.add_pending_ban([room_id], "@dev3:localhost:8008")
+
+        def broken_sync():
+            raise ValueError("Unexpected sync response")
+
+        reconciler = app.config["reconciler"]
+        monkeypatch.setattr(reconciler, "sync", broken_sync)
+        monkeypatch.setattr(reconciler, "pending_ban_batch_size", 1)
+        pending = room_index.count_pending_bans()
+        reconciler.reconcile()
+        assert room_index.count_pending_bans() == pending - 1
+
+
+def test_ban_replication_hot_rooms_first(appservice, sitename):
+    app = appservice.application
+    room_ids = {}
+    with app.app_context():
+        for name in ["hot", "cold"]:
+            appservice.authorized_request(
+                f"/_matrix/app/v1/rooms/%23comments_{sitename}_{name}:localhost:8008"
+            )
+            alias = f"#comments_{sitename}_{name}:localhost:8008"
+            room_ids[name] = room_id_from_alias(alias).json()["room_id"]
+        mod_alias = f"#comments_{sitename}:localhost:8008"
+        mod_room_id = room_id_from_alias(mod_alias).json()["room_id"]
+
+    message = {
+        "type": "m.room.message",
+        "room_id": room_ids["hot"],
+        "sender": "@dev2:localhost:8008",
+        "origin_server_ts": int(time.time() * 1000),
+        "content": {"msgtype": "m.text", "body": "Nice post!"},
+    }
+    ban = {
+        "type": "m.room.member",
+        "room_id": mod_room_id,
+        "sender": "@dev1:localhost:8008",
+        "state_key": "@dev3:localhost:8008",
+        "content": {"membership": "ban"},
+    }
+    for txn_id, event in enumerate([message, ban]):
+        r = appservice.authorized_request(
+            f"/_matrix/app/v1/transactions/{uuid.uuid4()}-{txn_id}",
+            method="PUT",
+            json={"events": [event]},
+        )
+        assert r.status_code == 200
+
+    with app.app_context():
+        room_index = app.config["room_index"]
+        assert "@dev3:localhost:8008" in get_room_state(room_ids["hot"])[0]
+        assert room_index.pending_bans(room_ids["cold"]) == ["@dev3:localhost:8008"]
+
+        # Activity in the cold room applies its pending bans
+        message["room_id"] = room_ids["cold"]
+        appservice.authorized_request(
+            f"/_matrix/app/v1/transactions/{uuid.uuid4()}",
+            method="PUT",
+            json={"events": [message]},
+        )
+        assert "@dev3:localhost:8008" in get_room_state(room_ids["cold"])[0]
+        assert room_index.pending_bans(room_ids["cold"]) == []
+
+
+def test_unban_in_mod_room_clears_pending_bans(unavailable_appservice):
+    app = unavailable_appservice.application
+    with app.app_context():
+        index_room("!mod:localhost:8008", "#comments_site:localhost:8008")
+        index_room("!post:localhost:8008", "#comments_site_post:localhost:8008")
+        room_index = app.config["room_index"]
+        room_index.add_pending_ban(["!post:localhost:8008"], "@dev3:localhost:8008")
+
+        handle_event(
+            {
+                "type": "m.room.member",
+                "room_id": "!mod:localhost:8008",
+                "sender": "@dev1:localhost:8008",
+                "state_key": "@dev3:localhost:8008",
+                "content": {"membership": "leave"},
+                "unsigned": {"prev_content": {"membership": "ban"}},
+            }
+        )
+        assert room_index.pending_bans("!post:localhost:8008") == []
+
+
+def test_admission_control_reserves_quota(unavailable_appservice):
+    app = unavailable_appservice.application
+    admission_control = AdmissionControl(max_rooms=2)
+    aliases = [f"#comments_site_{name}:localhost:8008" for name in "abc"]
+    with app.app_context():
+        # The moderation room does not count
+        index_room("!mod:localhost:8008", "#comments_site:localhost:8008")
+        assert admission_control.admit("site", aliases[0]) is None
+        assert admission_control.admit("site", aliases[1]) is None
+        # Rooms being created hold their slot
+        assert admission_control.admit("site", aliases[2]) == "quota_exceeded"
+
+        index_room("!a:localhost:8008", aliases[0])
+        admission_control.release(aliases[0])
+        assert admission_control.admit("site", aliases[2]) == "quota_exceeded"
+
+        # Creating the room failed
+        admission_control.release(aliases[1])
+        assert admission_control.admit("site", aliases[2]) is None
+
+
+def test_query_room_alias_rate_limited(appservice, sitename):
+    appservice.application.config["admission_control"] = AdmissionControl(
+        rate=0.001, burst=1
+    )
+    r1 = appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_first:localhost:8008"
+    )
+    assert r1.status_code == 200
+    r2 = appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_second:localhost:8008"
+    )
+    assert r2.status_code == 429
+    assert r2.get_json()["errcode"] == "CHAT.CACTUS.APPSERVICE_RATE_LIMITED"
+
+
+def test_query_room_alias_quota_exceeded(appservice, sitename):
+    appservice.application.config["admission_control"] = AdmissionControl(max_rooms=1)
+    r1 = appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_first:localhost:8008"
+    )
+    assert r1.status_code == 200
+    r2 = appservice.authorized_request(
+        f"/_matrix/app/v1/rooms/%23comments_{sitename}_second:localhost:8008"
+    )
+    assert r2.status_code == 403
+    assert r2.get_json()["errcode"] == "CHAT.CACTUS.APPSERVICE_QUOTA_EXCEEDED"
+
+    r = appservice.authorized_request("/_cactus/v1/metrics")
+    admission_control = r.get_json()["admission_control"][sitename]
+    assert admission_control == {"admitted": 1, "quota_exceeded": 1}
+
+
+def test_tenants_are_routed_by_hs_token(monkeypatch, tmp_path):
+    tenants = [
+        {
+            "CACTUS_HS_TOKEN": f"hs_token_{i}",
+            "CACTUS_AS_TOKEN": f"as_token_{i}",
+            "CACTUS_HOMESERVER_URL": "http://localhost:1",
+            "CACTUS_USER_ID": f"@cactusbot:tenant{i}.example",
+            "CACTUS_ROOM_INDEX_PATH": str(tmp_path / f"tenant{i}.sqlite3"),
+            "CACTUS_PROFILE_SAMPLE_RATE": i / 10,
+        }
+        for i in range(2)
+    ]
+    tenants_file = tmp_path / "tenants.json"
+    tenants_file.write_text(json.dumps(tenants))
+    monkeypatch.setenv("CACTUS_TENANTS_FILE", str(tenants_file))
+    monkeypatch.setenv("CACTUS_RECONCILE_INTERVAL", "0")
+    client = Client(create_wsgi_app_from_env())
+
+    for i in range(2):
+        r = client.get(
+            "/_cactus/v1/profiling", query_string={"access_token": f"hs_token_{i}"}
+        )
+        assert r.status_code == 200
+        assert r.get_json()["sample_rate"] == i / 10
+
+    r = client.get("/_cactus/v1/profiling", query_string={"access_token": "wrong"})
+    assert r.status_code == 403
+    r = client.get("/_cactus/v1/profiling")
+    assert r.status_code == 401
+
+
+def test_tenants_must_not_share_hs_token(monkeypatch, tmp_path, capsys):
+    tenants = [
+        {
+            "CACTUS_HS_TOKEN": "hs_token",
+            "CACTUS_AS_TOKEN": "as_token",
+            "CACTUS_HOMESERVER_URL": "http://localhost:1",
+            "CACTUS_ROOM_INDEX_PATH": str(tmp_path / f"tenant{i}.sqlite3"),
+        }
+        for i in range(2)
+    ]
+    tenants_file = tmp_path / "tenants.json"
+    tenants_file.write_text(json.dumps(tenants))
+    monkeypatch.setenv("CACTUS_TENANTS_FILE", str(tenants_file))
+    with pytest.raises(SystemExit):
+        create_wsgi_app_from_env()
+    assert "should not share CACTUS_HS_TOKEN" in capsys.readouterr().err
+
+
+def test_launcher_preloads_app(tmp_path):
+    app = create_unavailable_app(room_index_path=str(tmp_path / "index.sqlite3"))
+    options = {"bind": "127.0.0.1:5001", "workers": 2, "worker_class": "gthread"}
+    launcher = Launcher(app, options, time.monotonic())
+    assert launcher.cfg.preload_app
+    assert launcher.cfg.workers == 2
+    assert launcher.cfg.worker_class_str == "gthread"
+    assert launcher.load() is app
+
+
+def test_launcher_rejects_async_workers(monkeypatch):
+    monkeypatch.setenv("CACTUS_WORKER_CLASS", "gevent")
+    with pytest.raises(SystemExit):
+        launcher_options_from_env()